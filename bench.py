@@ -0,0 +1,430 @@
+"""
+Micro-benchmarks
+
+Usage: python bench.py [name ...] (all of them if no name is given)
+"""
+import sys
+from time import perf_counter
+import numpy as np
+
+BENCHMARKS = {}
+
+
+def benchmark(f):
+  BENCHMARKS[f.__name__] = f
+  return f
+
+
+def timeit(f,*args,n=None,duration=1):
+  """
+  Returns the average time of f(*args) in seconds
+
+  If n is None, runs f for about duration seconds
+  """
+  if n is None:
+    t0 = perf_counter()
+    f(*args)
+    n = max(1,int(duration/max(perf_counter()-t0,1e-9)))
+  t0 = perf_counter()
+  for _ in range(n):
+    f(*args)
+  return (perf_counter()-t0)/n
+
+
+def show(name,t,ref=None):
+  s = f"  {name:<30} {t*1000:10.3f} ms"
+  if ref is not None:
+    s += f" (x{ref/t:.1f})"
+  print(s)
+
+
+def _fresh_db(d,processes=None):
+  """
+  Returns a new empty Database in the directory d
+  """
+  import os
+  import builtins
+  from dedup import Database
+
+  os.makedirs(d,exist_ok=True)
+  cfg = os.path.join(d,'bench.cfg')
+  with open(cfg,'w') as f:
+    f.write(f"root_dir='{d}'\ndb_file='{d}/bench.db'\n"
+        f"vid_library='{d}/vid'\nvid_ext=['mp4']\nimg_ext=['png']\n")
+  ask,builtins.input = builtins.input,lambda *_: 'y'
+  try:
+    db = Database(cfg,processes)
+    db.reset()
+  finally:
+    builtins.input = ask
+  return db
+
+
+@benchmark
+def image_signature():
+  from dedup.image import make_signatures
+
+  def loop_signature(img): # Implementation before vectorization
+    h,w,_ = img.shape
+    Y,X = 3,3
+    sig = np.empty((Y,X,3),dtype=np.uint16)
+    for c in range(3):
+      for i in range(Y):
+        for j in range(X):
+          sig[i,j,c] = np.average(img[
+              int(h*i/Y):int(h*(i+1)/Y),
+              int(w*j/X):int(w*(j+1)/X),c])*256
+    return sig,np.average(img,axis=(0,1))
+
+  rng = np.random.default_rng(0)
+  for h,w in [(240,320),(1080,1920),(4000,6000)]:
+    img = rng.integers(0,256,(h,w,3),dtype=np.uint8)
+    print(f"{w}x{h} (per image)")
+    ref = timeit(loop_signature,img)
+    show("loop + average",ref)
+    show("make_signatures (single)",timeit(make_signatures,[img]),ref)
+    batch = [img]*16
+    show("make_signatures (batch of 16)",
+        timeit(make_signatures,batch)/len(batch),ref)
+
+
+@benchmark
+def image_decode():
+  import os
+  import cv2
+  from tempfile import TemporaryDirectory
+  from dedup.image import decode,make_signatures
+  from dedup.probe import probe_image
+
+  def full(path):
+    return make_signatures([cv2.imread(path,cv2.IMREAD_COLOR)])
+
+  def reduced(path):
+    return make_signatures([decode(path,probe_image(path))])
+
+  # A smooth image with some noise, closer to a photo than pure noise
+  rng = np.random.default_rng(0)
+  with TemporaryDirectory() as d:
+    for h,w in [(1080,1920),(4000,6000)]:
+      y,x = np.mgrid[0:h,0:w]
+      img = np.stack([x*255//w,y*255//h,(x+y)*255//(w+h)],axis=-1)
+      img = (img+rng.integers(0,8,img.shape)).clip(0,255).astype(np.uint8)
+      path = os.path.join(d,f"{w}x{h}.jpg")
+      cv2.imwrite(path,img)
+      print(f"{w}x{h} JPEG (per image)")
+      ref = timeit(full,path)
+      show("full decode",ref)
+      show("reduced decode",timeit(reduced,path),ref)
+      diff = np.abs(full(path)[0].astype(int)-reduced(path)[0]).max()
+      print(f"  max signature difference: {diff/256:.2f}/255")
+
+
+@benchmark
+def hashing():
+  import os
+  import hashlib
+  from tempfile import TemporaryDirectory
+  from dedup.hashing import hash_file,HASHES,M
+
+  def read_md5(fname,bs=M): # Implementation before readinto
+    h = hashlib.md5()
+    with open(fname,'rb') as f:
+      chunk = f.read(bs)
+      while chunk:
+        h.update(chunk)
+        chunk = f.read(bs)
+      return h.digest()
+
+  size = 256*M
+  with TemporaryDirectory() as d:
+    path = os.path.join(d,'data')
+    with open(path,'wb') as f:
+      f.write(os.urandom(size))
+    print(f"{size//M} MiB file in page cache (per file)")
+    ref = timeit(read_md5,path)
+    show("md5 (read)",ref)
+    for algo in HASHES:
+      t = timeit(hash_file,path,M,algo)
+      show(f"{algo} ({size/M/t:.0f} MiB/s)",t,ref)
+
+
+@benchmark
+def image_search():
+  from dedup.image_match import similar_pairs
+
+  def run(*args):
+    return sum(len(a) for a,_,_ in similar_pairs(*args))
+
+  rng = np.random.default_rng(0)
+  for n in [10000,100000]:
+    # Clusters of similar images with common aspect ratios
+    base = rng.uniform(0,255,(n//4,27)).astype(np.float32)
+    sigs = (base[rng.integers(0,len(base),n)]
+        +rng.normal(0,2,(n,27))).clip(0,255).astype(np.float32)
+    brightness = np.stack([sigs[:,c::3].mean(axis=1) for c in range(3)],1)
+    sizes = np.array([[4,3],[3,2],[16,9],[3,4]],
+        dtype=np.float64)[rng.integers(0,4,n)]
+    ids = np.arange(n)
+    print(f"{n} images, all vs all (total)")
+    t = timeit(run,ids,sizes,brightness,sigs,n=1)
+    show(f"similar_pairs ({run(ids,sizes,brightness,sigs)} pairs)",t)
+
+
+@benchmark
+def phash_search():
+  from dedup.phash import PHashIndex,popcount
+
+  rng = np.random.default_rng(0)
+  for n in [10000,100000]:
+    # Clusters of hashes differing by a few bits
+    base = rng.integers(-2**63,2**63-1,n//4,dtype=np.int64)
+    flip = np.zeros(n,dtype=np.uint64)
+    for _ in range(4):
+      flip |= np.uint64(1) << rng.integers(0,64,n).astype(np.uint64)
+    hashes = base[rng.integers(0,len(base),n)] ^ flip.view(np.int64)
+    ids = np.arange(n)
+    index = PHashIndex(ids,hashes)
+    print(f"{n} hashes, within 6 bits")
+    ref = timeit(lambda h: ids[popcount(index.hashes ^ h) <= 6],
+        index.hashes[0])
+    show("linear scan (single)",ref)
+    show("PHashIndex.query (single)",
+        timeit(index.query,int(hashes[0]),6),ref)
+    show("linear scan (all pairs, estimated)",ref*n)
+    show(f"PHashIndex.pairs ({len(index.pairs(6)[0])} pairs)",
+        timeit(index.pairs,6,n=1),ref*n)
+
+
+@benchmark
+def video_search():
+  from dedup.video_match import included_pairs
+
+  def run(sigs,coarse):
+    return sum(len(a) for a,_,_,_ in included_pairs(sigs,24,coarse=coarse))
+
+  rng = np.random.default_rng(0)
+  for n in [500,2000]:
+    # Smooth color signals, from 1 minute to 2 hours (median: 10 minutes)
+    lens = np.clip(rng.lognormal(np.log(240),1,n),24,2880).astype(int)
+    sigs = [(np.cumsum(rng.normal(0,4,(t,3)),axis=0)+128).clip(0,255).astype(
+        np.uint8) for t in lens]
+    print(f"{n} videos, all vs all (total)")
+    ref = timeit(run,sigs,1,n=1)
+    show("included_pairs (full resolution)",ref)
+    show("included_pairs (coarse=4)",timeit(run,sigs,4,n=1),ref)
+
+
+@benchmark
+def shot_lookup():
+  from dedup.video_match import ShotIndex,shot_keys
+
+  rng = np.random.default_rng(0)
+  n = 10000
+  # Shots of 2 to 60 seconds, 1 minute to 2 hours long videos
+  cuts = [np.cumsum(rng.integers(4,120,rng.integers(10,500)))
+      for _ in range(n)]
+  # A tenth of the videos are clips of other ones
+  for i in rng.choice(n,n//10,replace=False):
+    c = cuts[rng.integers(0,n)]
+    start = rng.integers(0,max(len(c)-10,1))
+    cuts[i] = c[start:start+rng.integers(10,40)]-c[start]
+  keys = [shot_keys(c) for c in cuts]
+  ids = np.concatenate([[i]*len(k) for i,(k,_) in enumerate(keys)])
+  index = ShotIndex(np.concatenate([k for k,_ in keys]),ids,
+      np.concatenate([f for _,f in keys]))
+  print(f"{n} videos, {len(ids)} keys")
+  t = timeit(lambda: [index.candidates(i,cuts[i]) for i in range(100)],
+      n=1)/100
+  show("ShotIndex.candidates (per video)",t)
+  print(f"  all the library: {t*n:.1f} s")
+
+
+@benchmark
+def signature_store():
+  import os
+  from tempfile import TemporaryDirectory
+  from dedup.store import Store
+  from dedup.video import Y,X
+
+  rng = np.random.default_rng(0)
+  n = 2000
+  sigs = [rng.integers(0,256,(t,Y,X,3),dtype=np.uint8)
+      for t in rng.integers(20,200,n)]
+  with TemporaryDirectory() as d:
+    for i,a in enumerate(sigs):
+      np.save(os.path.join(d,f"{i}.npy"),a)
+    store = Store(os.path.join(d,'store'),(Y,X,3))
+    locations = [store.append(a) for a in sigs]
+
+    def load_npy():
+      return [np.load(os.path.join(d,f"{i}.npy")) for i in range(n)]
+
+    def load_store():
+      store._maps = {} # Maps the packs again
+      return [store.get(*l) for l in locations]
+
+    print(f"{n} signatures, {sum(a.nbytes for a in sigs)/2**20:.0f} MiB "
+        "(all of them)")
+    ref = timeit(load_npy,n=3)
+    show("np.load of each npy file",ref)
+    show("views of the store",timeit(load_store,n=3),ref)
+    show("views of the store + reading",timeit(
+      lambda: [int(a[-1,-1,-1,-1]) for a in load_store()],n=3),ref)
+    store.close()
+
+
+@benchmark
+def bulk_load():
+  import tracemalloc
+  from tempfile import TemporaryDirectory
+  from dedup.database import FILE_SQL,IMG_SQL
+
+  rng = np.random.default_rng(0)
+  n = 20000
+  with TemporaryDirectory() as d:
+    db = _fresh_db(d)
+    paths = [f"{d}/{i}.png" for i in range(n)]
+    db.db.executemany(FILE_SQL,[(i+1,p,bytes(16),int(s),1,None,0,0,0,
+      db.hash_version) for i,(p,s) in enumerate(zip(paths,
+        rng.integers(1000,10**7,n)))])
+    db.db.executemany(IMG_SQL,[(i+1,480,640,100,100,100,
+      rng.integers(0,65536,27,dtype=np.uint16).tobytes(),3,
+      int(rng.integers(-2**63,2**63-1))) for i in range(n)])
+    db.db.commit()
+
+    def memory(f):
+      tracemalloc.start()
+      r = f()
+      size = tracemalloc.get_traced_memory()[0]
+      tracemalloc.stop()
+      del r
+      return size/2**20
+
+    print(f"{n} images")
+    ref = timeit(lambda: [db.get_file(p) for p in paths],n=1)
+    show("get_file for each path",ref)
+    show("get_files",timeit(db.get_files,paths,n=1),ref)
+    show("catalog",timeit(db.catalog,n=1),ref)
+    print(f"  memory: {memory(lambda: db.get_files(paths)):.1f} MiB "
+        f"(File objects), {memory(db.catalog):.1f} MiB (catalog)")
+    db.close()
+
+
+@benchmark
+def io_order():
+  import os
+  import random
+  from tempfile import TemporaryDirectory
+  from dedup.hashing import quick_hash_file,M
+  from dedup.iosched import order,is_rotational
+
+  n,size,bs = 1000,M,64*1024
+
+  def evict(paths):
+    for p in paths:
+      fd = os.open(p,os.O_RDONLY)
+      os.fsync(fd)
+      os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+      os.close(fd)
+
+  def run(paths):
+    evict(paths)
+    t0 = perf_counter()
+    for p in paths:
+      quick_hash_file(p,bs)
+    return perf_counter()-t0
+
+  with TemporaryDirectory(dir='.') as d:
+    paths = [os.path.join(d,str(i)) for i in range(n)]
+    for p in paths:
+      with open(p,'wb') as f:
+        f.write(os.urandom(size))
+    rot = is_rotational(os.stat(d).st_dev)
+    print(f"{n} files of {size//M} MiB, not cached "
+        f"(rotational: {rot}), quick hash of 3 blocks of {bs//1024} KiB")
+    random.seed(0)
+    shuffled = random.sample(paths,n)
+    ref = run(shuffled)
+    show("random order",ref)
+    show("scheduler order",run(order(shuffled)),ref)
+
+
+@benchmark
+def cross_library():
+  from tempfile import TemporaryDirectory
+  from dedup import CrossLibrary
+  from dedup.database import FILE_SQL,IMG_SQL
+
+  rng = np.random.default_rng(0)
+  n_dest,n_src,n_copies = 100000,5000,500
+  # Images: a random level per image and noise in the cells
+  level = rng.integers(0,256,n_dest+n_src)
+  sigs = np.clip(level[:,None]+rng.integers(-30,31,(n_dest+n_src,27)),0,255)
+  files = [(f"{i}.png",bytes(rng.integers(0,256,16,dtype=np.uint8)),
+    int(s)) for i,s in enumerate(rng.integers(1000,10**7,n_dest+n_src))]
+  hashes = rng.integers(-2**63,2**63-1,n_dest+n_src)
+  copies = rng.choice(n_dest,n_copies,replace=False)
+  for i,j in zip(range(n_dest,n_dest+n_copies),copies.tolist()):
+    files[i],sigs[i],hashes[i] = files[j],sigs[j],hashes[j]
+
+  def make(d,rows):
+    db = _fresh_db(d)
+    db.db.executemany(FILE_SQL,[(k+1,f"{d}/{files[i][0]}",files[i][1],
+      files[i][2],1,files[i][1],0,0,0,db.hash_version)
+      for k,i in enumerate(rows)])
+    db.db.executemany(IMG_SQL,[(k+1,480,640)+(int(level[i])*256,)*3+(
+      (sigs[i]*256).astype(np.uint16).tobytes(),3,int(hashes[i]))
+      for k,i in enumerate(rows)])
+    db.db.commit()
+    db.close()
+    return f"{d}/bench.db"
+
+  with TemporaryDirectory() as d:
+    dest = make(f"{d}/dest",range(n_dest))
+    src = make(f"{d}/src",range(n_dest,n_dest+n_src))
+    print(f"{n_src} images against {n_dest} ({n_copies} copies)")
+    with CrossLibrary([src],[dest]) as x:
+      for name in ['identical','similar_phash','similar_images']:
+        f = getattr(x,name)
+        show(f"{name} ({len(f())} pairs)",timeit(f,n=1))
+
+
+@benchmark
+def lookup():
+  import os
+  from tempfile import TemporaryDirectory
+  from dedup.database import FILE_SQL
+  from dedup.hashing import quick_hash_file,M
+
+  rng = np.random.default_rng(0)
+  n = 100000
+  with TemporaryDirectory() as d:
+    db = _fresh_db(d,1)
+    sizes = rng.choice(np.arange(10**4,10**8,7),n,replace=False)
+    db.db.executemany(FILE_SQL,[(i+1,f"{d}/{i}",
+      bytes(rng.integers(0,256,16,dtype=np.uint8)),int(s),0,None,0,0,0,
+      db.hash_version) for i,s in enumerate(sizes)])
+    # A file of the db, one with the size of another file and one
+    # with a new size (4 MiB: hashed by blocks)
+    size = 4*M+1
+    paths = {}
+    for name,s in (('hit',size),('qhash miss',int(sizes[0])),
+        ('size miss',size+1)):
+      paths[name] = os.path.join(d,name)
+      with open(paths[name],'wb') as f:
+        f.write(os.urandom(s))
+    db.db.execute("""UPDATE files SET path = ?, size = ?, qhash = ?
+    WHERE id = 2""",(paths['hit'],size,
+      quick_hash_file(paths['hit'],db.cfg.hash_bs)))
+    db.db.commit()
+    print(f"{n} files in the db, files in page cache")
+    show("loading the filter",timeit(db.lookup_filter,True,n=3))
+    for name,p in paths.items():
+      show(f"find_identical ({name})",timeit(db.find_identical,p))
+    db.close()
+
+
+if __name__ == '__main__':
+  for name in sys.argv[1:] or BENCHMARKS:
+    print(f"== {name} ==")
+    BENCHMARKS[name]()
@@ -1,4 +1,5 @@
 from .database import Database
+from .crosslib import CrossLibrary
 #from .image import Image
 #from .video import Video
 #from .config import Config
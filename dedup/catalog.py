@@ -0,0 +1,205 @@
+import numpy as np
+
+from .file import IMAGE,VIDEO
+
+
+def _align(ids,rows):
+  """
+  Returns the rows whose id (first column) is in ids (sorted)
+  and their positions in ids
+  """
+  rid = np.array([r[0] for r in rows],dtype=np.int64)
+  i = np.minimum(np.searchsorted(ids,rid),max(len(ids)-1,0))
+  keep = ids[i] == rid if len(ids) else np.zeros(len(rid),dtype=bool)
+  return [r for r,k in zip(rows,keep.tolist()) if k],i[keep]
+
+
+class Catalog:
+  """
+  Columnar copy of the files, img and vid tables: one array per column,
+  with a row per file (sorted by id), to work on whole columns at once
+
+  Columns:
+    id, type, size, mtime (0 if unknown): int64 arrays
+    path: list of str
+    has_hash: bool, the full hash is known
+    height, width: int32 (0 if unknown or not a media)
+    brightness: (n,3) float32 average colors of the images (0-255)
+    length: int32 length of the videos in seconds, duration: float64 (NaN)
+    phash: int64 perceptual hash of the images, has_phash: bool
+    signatures: (k,grid,grid,3) uint16 signatures of the images made with
+      the grid of the catalog, sig_row: int32 row in signatures (-1 if none)
+    sigrgb: (total,3) uint8 color signals of the videos end to end,
+      sigrgb_start: int64, sigrgb_len: int32 (-1 if none)
+  Catalog[i] is a lightweight view of the row i (see Entry)
+  """
+  def __init__(self,files,img=(),vid=(),grid=3):
+    self.grid = grid
+    n = len(files)
+    cols = list(zip(*files)) if n else [()]*6
+    self.id = np.array(cols[0],dtype=np.int64)
+    self.path = list(cols[1])
+    self.type = np.array(cols[2],dtype=np.int64)
+    self.size = np.array([s or 0 for s in cols[3]],dtype=np.int64)
+    self.mtime = np.array([m or 0 for m in cols[4]],dtype=np.int64)
+    self.has_hash = np.array(cols[5] if n else [],dtype=bool)
+    self.height = np.zeros(n,dtype=np.int32)
+    self.width = np.zeros(n,dtype=np.int32)
+    self.brightness = np.zeros((n,3),dtype=np.float32)
+    self.length = np.zeros(n,dtype=np.int32)
+    self.duration = np.full(n,np.nan)
+    self.phash = np.zeros(n,dtype=np.int64)
+    self.has_phash = np.zeros(n,dtype=bool)
+    self.sig_row = np.full(n,-1,dtype=np.int32)
+    self.sigrgb_start = np.zeros(n,dtype=np.int64)
+    self.sigrgb_len = np.full(n,-1,dtype=np.int32)
+    self._index = None
+    self._load_img(img)
+    self._load_vid(vid)
+
+  def _load_img(self,rows):
+    """
+    rows: (id,height,width,r,g,b,grid,signature,phash)
+    """
+    rows,i = _align(self.id,rows)
+    for col,k in ((self.height,1),(self.width,2)):
+      col[i] = [r[k] or 0 for r in rows]
+    self.brightness[i] = np.array([[c or 0 for c in r[3:6]] for r in rows],
+        dtype=np.float32).reshape(-1,3)/256
+    ph = [(j,r[8]) for j,r in zip(i.tolist(),rows) if r[8] is not None]
+    if ph:
+      j,h = zip(*ph)
+      self.phash[list(j)] = h
+      self.has_phash[list(j)] = True
+    sig = [(j,r[7]) for j,r in zip(i.tolist(),rows)
+        if r[7] is not None and r[6] == self.grid]
+    g = self.grid
+    self.signatures = np.frombuffer(b''.join(s for _,s in sig),
+        dtype=np.uint16).reshape(-1,g,g,3)
+    self.sig_row[[j for j,_ in sig]] = np.arange(len(sig))
+
+  def _load_vid(self,rows):
+    """
+    rows: (id,height,width,length,duration,sigrgb)
+    """
+    rows,i = _align(self.id,rows)
+    for col,k in ((self.height,1),(self.width,2),(self.length,3)):
+      col[i] = [r[k] or 0 for r in rows]
+    self.duration[i] = [np.nan if r[4] is None else r[4] for r in rows]
+    sig = [(j,r[5]) for j,r in zip(i.tolist(),rows) if r[5] is not None]
+    lens = np.array([len(s)//3 for _,s in sig],dtype=np.int64)
+    j = [j for j,_ in sig]
+    self.sigrgb = np.frombuffer(b''.join(s for _,s in sig),
+        dtype=np.uint8).reshape(-1,3)
+    self.sigrgb_start[j] = np.cumsum(lens)-lens
+    self.sigrgb_len[j] = lens
+
+  def __len__(self):
+    return len(self.id)
+
+  def __getitem__(self,i):
+    return Entry(self,int(i))
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield Entry(self,i)
+
+  def row(self,path):
+    """
+    Returns the row of a file given its path (KeyError if not found)
+    """
+    if self._index is None:
+      self._index = dict((p,i) for i,p in enumerate(self.path))
+    return self._index[path]
+
+  def rows(self,ids):
+    """
+    Returns the rows of the given ids (that must be in the catalog)
+    """
+    return np.searchsorted(self.id,np.asarray(ids,dtype=np.int64))
+
+  def of_type(self,t):
+    """
+    Returns the rows of the files of type t (IMAGE, VIDEO or NOMEDIA)
+    """
+    return np.nonzero(self.type == t)[0]
+
+  def get_sigrgb(self,i):
+    """
+    Returns the color signal of the video of row i (a view), or None
+    """
+    n = self.sigrgb_len[i]
+    if n < 0:
+      return None
+    s = self.sigrgb_start[i]
+    return self.sigrgb[s:s+n]
+
+
+class Entry:
+  """
+  View of a row of a Catalog, reading its columns on access
+  """
+  __slots__ = ('catalog','i')
+
+  def __init__(self,catalog,i):
+    self.catalog = catalog
+    self.i = i
+
+  id = property(lambda self: int(self.catalog.id[self.i]))
+  path = property(lambda self: self.catalog.path[self.i])
+  type = property(lambda self: int(self.catalog.type[self.i]))
+  size = property(lambda self: int(self.catalog.size[self.i]))
+  mtime = property(lambda self: int(self.catalog.mtime[self.i]))
+  height = property(lambda self: int(self.catalog.height[self.i]))
+  width = property(lambda self: int(self.catalog.width[self.i]))
+  length = property(lambda self: int(self.catalog.length[self.i]))
+  duration = property(lambda self: float(self.catalog.duration[self.i]))
+
+  @property
+  def brightness(self):
+    return tuple(self.catalog.brightness[self.i].tolist())
+
+  @property
+  def phash(self):
+    c = self.catalog
+    return int(c.phash[self.i]) if c.has_phash[self.i] else None
+
+  @property
+  def signature(self):
+    k = self.catalog.sig_row[self.i]
+    return None if k < 0 else self.catalog.signatures[k]
+
+  @property
+  def sigrgb(self):
+    return self.catalog.get_sigrgb(self.i)
+
+  def __repr__(self):
+    t = {IMAGE:'IMAGE',VIDEO:'VIDEO'}.get(self.type,'NOMEDIA')
+    return f"<Entry:{t}> {self.path}"
+
+
+def load(db,grid=3,types=None,sigrgb=True,schema='main'):
+  """
+  Loads a Catalog from the db in three queries
+
+  types is an optional list of the types of files to load and the video
+  signals are only loaded if sigrgb is True
+  schema is the name of the attached db to read (see crosslib)
+  """
+  cur = db.cursor()
+  where = ""
+  if types is not None:
+    where = f"WHERE type IN ({','.join(str(int(t)) for t in types)})"
+  cur.execute(f"""SELECT id,path,type,size,mtime,hash IS NOT NULL
+  FROM {schema}.files {where} ORDER BY id""")
+  files = cur.fetchall()
+  img = vid = []
+  if types is None or IMAGE in types:
+    cur.execute(f"""SELECT id,height,width,r,g,b,grid,signature,phash
+    FROM {schema}.img ORDER BY id""")
+    img = cur.fetchall()
+  if types is None or VIDEO in types:
+    cur.execute(f"""SELECT id,height,width,length,duration,
+    {'sigrgb' if sigrgb else 'NULL'} FROM {schema}.vid ORDER BY id""")
+    vid = cur.fetchall()
+  return Catalog(files,img,vid,grid)
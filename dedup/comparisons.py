@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class ComparisonState:
+  """
+  Progress of the comparators, kept in the comparison_state table so that
+  each run only compares the files added since the previous one
+
+  A comparator has compared with each other all the files with an id up
+  to its watermark, with the given parameters (a str), except the stale
+  ones: the files whose signature changed since (see the triggers of
+  Database._create_comparison_tables, that also remove their pairs).
+  The next run compares the new files (above the watermark) and the
+  stale ones with all the others
+  """
+  def __init__(self,db):
+    self.db = db
+
+  def watermark(self):
+    """
+    Returns the watermark to save after a run starting now: the highest
+    id of the files
+    """
+    cur = self.db.execute("SELECT max(id) FROM files")
+    return cur.fetchone()[0] or 0
+
+  def new(self,comparator,params,ids):
+    """
+    Returns a bool array telling which of the ids have to be compared,
+    or None if they all have to (the comparator never ran or it ran
+    with other parameters)
+    """
+    cur = self.db.execute("""SELECT watermark FROM comparison_state
+    WHERE comparator = ? AND params = ?""",(comparator,params))
+    r = cur.fetchone()
+    if r is None:
+      return None
+    cur.execute("SELECT id FROM comparison_stale WHERE comparator = ?",
+        (comparator,))
+    stale = np.array([i for i, in cur.fetchall()],dtype=np.int64)
+    ids = np.asarray(ids,dtype=np.int64)
+    return (ids > r[0]) | np.isin(ids,stale)
+
+  def save(self,comparator,params,watermark):
+    """
+    Records a run of the comparator (committed with its results)
+    """
+    self.db.execute("""INSERT OR REPLACE INTO comparison_state
+    (comparator,params,watermark) VALUES (?,?,?)""",
+    (comparator,params,watermark))
+    self.db.execute("DELETE FROM comparison_stale WHERE comparator = ?",
+        (comparator,))
@@ -7,7 +7,10 @@ def read_config(fname):
 
 class Config:
   def __init__(self,config_file='config.cfg',
-      expected_param=['root_dir','db_file','vid_library','vid_ext','img_ext']):
+      expected_param=['root_dir','db_file','vid_library','vid_ext','img_ext'],
+      optional_param={'exclusion':[],'walk_threads':0,'img_grid':3,
+        'hash_algo':'md5','hash_bs':1048576,'vid_mode':'full',
+        'sig_timeout':3600,'sig_max_memory':8192,'io_hdd':1,'io_ssd':None}):
     try:
       config = read_config(config_file)
     except Exception:
@@ -19,15 +22,27 @@ class Config:
       except KeyError:
         print(f"Missing parameter in config: {k}")
         raise
+    for k,default in optional_param.items():
+      setattr(self,k,config.pop(k,default))
     if not self.root_dir.endswith("/"):
       self.root_dir += "/"
     if not self.vid_library.endswith("/"):
       self.vid_library += "/"
     if config:
       raise AttributeError("Unexpected config parameter(s): {config}")
-    for param in (self.root_dir,self.db_file,self.vid_library):
+    for param in (self.root_dir,self.db_file,self.vid_library,self.hash_algo):
       assert isinstance(param,str),f"Invalid config parameter: {param}"
-    for param in (self.vid_ext,self.img_ext):
+    assert self.vid_mode in ['full','keyframes','auto'],\
+        f"Invalid config parameter: {self.vid_mode}"
+    for param in (self.vid_ext,self.img_ext,self.exclusion):
       assert isinstance(param,list),f"Invalid config parameter: {param}"
       for ext in param:
         assert isinstance(ext,str),f"Invalid config parameter: {param}"
+    for param in (self.walk_threads,self.img_grid,self.hash_bs,
+        self.sig_timeout,self.sig_max_memory,self.io_hdd):
+      assert isinstance(param,int),f"Invalid config parameter: {param}"
+    # Files read at once per device (io_ssd: the number of processes
+    # if None, see Database._imap_io)
+    assert self.io_hdd >= 1,f"Invalid config parameter: {self.io_hdd}"
+    assert self.io_ssd is None or isinstance(self.io_ssd,int) and \
+        self.io_ssd >= 1,f"Invalid config parameter: {self.io_ssd}"
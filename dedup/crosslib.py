@@ -0,0 +1,172 @@
+import os
+from itertools import product
+import numpy as np
+import sqlite3
+
+from .file import IMAGE,VIDEO
+from .hashing import hash_file,parse_version
+from .iosched import order
+from .image_match import similar_pairs
+from . import video_match
+from . import phash
+from . import catalog
+
+
+class CrossLibrary:
+  """
+  Compares the files of source libraries with the ones of dest libraries,
+  never with the files of their own group
+
+  The libraries are existing dbs of Database, attached to a single
+  connection (SQLite ATTACH) as src0, src1... and dst0, dst1...: the
+  exact comparisons are indexed joins between the files tables of the
+  groups. Nothing is rescanned, only the data stored in the dbs is used
+  (see Database.detect_and_add and compute_*_signature).
+  A db can be in both groups: a file is never matched with itself
+  The results are lists of (source path,dest path,...)
+  """
+  def __init__(self,source,dest,img_grid=3):
+    self.img_grid = img_grid
+    self.db = sqlite3.connect(':memory:',timeout=60)
+    self.source = self._attach('src',source)
+    self.dest = self._attach('dst',dest)
+
+  def _attach(self,prefix,db_files):
+    names = []
+    for i,db_file in enumerate(db_files):
+      assert os.path.exists(db_file),f"No such db: {db_file}"
+      names.append(f"{prefix}{i}")
+      self.db.execute(f"ATTACH DATABASE ? AS {names[-1]}",(db_file,))
+    return names
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*_):
+    self.close()
+
+  def identical(self):
+    """
+    Returns the list of (source path,dest path) of the identical files
+
+    The candidates share their size and qhash: each source file is looked
+    up in the files_size index of the dest (CROSS JOIN keeps this order,
+    the source is expected to be the smaller group). Their missing hashes
+    are computed and saved in their db
+    Files hashed with different algorithms are not compared
+    """
+    cand = []
+    for s,d in product(self.source,self.dest):
+      cur = self.db.execute(f"""SELECT a.hash_algo,a.path,a.hash,b.path,
+      b.hash FROM {s}.files a CROSS JOIN {d}.files b ON b.size = a.size
+      AND b.qhash = a.qhash AND b.hash_algo = a.hash_algo
+      WHERE a.path != b.path""")
+      cand += [(s,d)+r for r in cur.fetchall()]
+    missing = {}
+    for s,d,version,pa,ha,pb,hb in cand:
+      for schema,p,h in ((s,pa,ha),(d,pb,hb)):
+        if h is None:
+          missing.setdefault(p,(version,set()))[1].add(schema)
+    hashes = {}
+    for p in order(list(missing)):
+      algo,bs = parse_version(missing[p][0])
+      try:
+        hashes[p] = hash_file(p,bs,algo)
+      except OSError as e: # Moved or deleted since the last scan
+        print(f"Could not hash {p}: {e}")
+        continue
+      for schema in missing[p][1]:
+        self.db.execute(f"UPDATE {schema}.files SET hash = ? WHERE path = ?",
+            (hashes[p],p))
+    self.db.commit()
+    r = set()
+    for _,_,_,pa,ha,pb,hb in cand:
+      ha,hb = ha or hashes.get(pa),hb or hashes.get(pb)
+      if ha is not None and ha == hb:
+        r.add((pa,pb))
+    return sorted(r)
+
+  def _load(self,t,sigrgb=False):
+    """
+    Returns the catalogs of the files of type t of all the libraries and
+    whether they are in the source group
+    """
+    return [(catalog.load(self.db,self.img_grid,[t],sigrgb,schema),
+        schema in self.source) for schema in self.source+self.dest]
+
+  @staticmethod
+  def _across(paths,src,a,b,*values):
+    """
+    Keeps the pairs of indices (a,b) between the groups, as a list of
+    (source path,dest path,values...)
+    """
+    keep = src[a] != src[b]
+    a,b = a[keep],b[keep]
+    values = [v[keep].tolist() for v in values]
+    a,b = np.where(src[a],a,b),np.where(src[a],b,a)
+    return [(paths[i],paths[j],*v) for i,j,*v in
+        zip(a.tolist(),b.tolist(),*values) if paths[i] != paths[j]]
+
+  def similar_images(self,max_diff=8,max_ratio_diff=0.05):
+    """
+    Returns the similar images as (source path,dest path,diff), the most
+    similar first (see Database.compare_images)
+
+    Only the pairs with a source image are computed
+    """
+    paths,src,sizes,brightness,sigs = [],[],[],[],[]
+    for c,is_src in self._load(IMAGE):
+      rows = np.nonzero((c.sig_row >= 0) & (c.width > 0) & (c.height > 0))[0]
+      paths += [c.path[i] for i in rows.tolist()]
+      src.append(np.full(len(rows),is_src))
+      sizes.append(np.stack([c.width[rows],c.height[rows]],axis=1))
+      brightness.append(c.brightness[rows])
+      sigs.append(c.signatures[c.sig_row[rows]].reshape(len(rows),
+          3*self.img_grid**2))
+    src = np.concatenate(src)
+    sigs = np.concatenate(sigs).astype(np.float32)/256
+    r = []
+    for a,b,diff in similar_pairs(np.arange(len(paths)),
+        np.concatenate(sizes).astype(np.float64),np.concatenate(brightness),
+        sigs,max_diff,max_ratio_diff,new=src):
+      r += self._across(paths,src,a,b,diff)
+    return sorted(r,key=lambda t:t[2])
+
+  def similar_phash(self,max_dist=6):
+    """
+    Returns the images with close perceptual hashes as
+    (source path,dest path,dist), the closest first
+    """
+    paths,src,hashes = [],[],[]
+    for c,is_src in self._load(IMAGE):
+      rows = np.nonzero(c.has_phash)[0]
+      paths += [c.path[i] for i in rows.tolist()]
+      src.append(np.full(len(rows),is_src))
+      hashes.append(c.phash[rows])
+    src = np.concatenate(src)
+    index = phash.PHashIndex(np.arange(len(paths)),np.concatenate(hashes))
+    a,b,dist = index.pairs(max_dist,src)
+    return sorted(self._across(paths,src,a,b,dist),key=lambda t:t[2])
+
+  def similar_videos(self,min_score=0.9,min_length=60):
+    """
+    Returns the videos contained in one another (or identical) as
+    (source path,dest path,score), the best first
+    (see Database.compare_videos)
+    """
+    paths,src,sigs = [],[],[]
+    for c,is_src in self._load(VIDEO,sigrgb=True):
+      rows = np.nonzero(c.sigrgb_len >= 0)[0]
+      paths += [c.path[i] for i in rows.tolist()]
+      src += [is_src]*len(rows)
+      sigs += [c.get_sigrgb(i) for i in rows.tolist()]
+    src = np.array(src,dtype=bool)
+    min_len = max(int(np.ceil(min_length/video_match.period)),2)
+    r = []
+    for ia,ib,score,_ in video_match.included_pairs(sigs,min_len,min_score,
+        new=src):
+      r += self._across(paths,src,ia,ib,score)
+    return sorted(r,key=lambda t:-t[2])
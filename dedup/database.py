@@ -1,61 +1,191 @@
 import os
 from shutil import rmtree
-from typing import List
+from typing import List,Iterable
+from itertools import groupby
+from functools import partial
 from multiprocessing import Pool,cpu_count
+import threading
+from time import sleep
 import numpy as np
 import sqlite3
 
 from .file import File,IMAGE,VIDEO,NOMEDIA
-from .video import Video
+from .hashing import hash_file,quick_hash_file,compare_files,hash_version,\
+    get_hash,M
+from .video import Video,fps,Y,X
+from .store import get_store
 from .image import Image
 from .config import Config
+from .walk import walk
+from .writer import Writer
+from .jobs import JobQueue,Heartbeat,worker_name
+from .iosched import IOScheduler,order
+from .comparisons import ComparisonState
+from .lookup_filter import LookupFilter
+from .image_match import similar_pairs
+from . import video_match
+from . import phash
+from . import catalog
+
+# Statements used to write the tables, keyed by file id
+# (the same statement is used to insert or update, see mkargs_*)
+FILE_SQL = """INSERT INTO files
+(id,path,qhash,size,type,hash,mtime,inode,dev,hash_algo)
+VALUES (?,?,?,?,?,?,?,?,?,?) ON CONFLICT(path) DO UPDATE SET
+qhash = excluded.qhash, size = excluded.size, type = excluded.type,
+hash = excluded.hash, mtime = excluded.mtime, inode = excluded.inode,
+dev = excluded.dev, hash_algo = excluded.hash_algo"""
+IMG_SQL = """INSERT INTO img (id,height,width,r,g,b,signature,grid,phash)
+VALUES (?,?,?,?,?,?,?,?,?) ON CONFLICT(id) DO UPDATE SET
+height = excluded.height, width = excluded.width, r = excluded.r,
+g = excluded.g, b = excluded.b, signature = excluded.signature,
+grid = excluded.grid, phash = excluded.phash"""
+VID_SQL = """INSERT INTO vid
+(id,height,width,length,sigrgb,shots,sig_pack,sig_offset,sig_length,
+duration,frame_rate,codec,streams,probe_size,probe_mtime,sig_mode,sig_error)
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(id) DO UPDATE SET
+height = excluded.height, width = excluded.width, length = excluded.length,
+sigrgb = excluded.sigrgb, shots = excluded.shots,
+sig_pack = excluded.sig_pack, sig_offset = excluded.sig_offset,
+sig_length = excluded.sig_length, duration = excluded.duration,
+frame_rate = excluded.frame_rate, codec = excluded.codec,
+streams = excluded.streams, probe_size = excluded.probe_size,
+probe_mtime = excluded.probe_mtime, sig_mode = excluded.sig_mode,
+sig_error = excluded.sig_error"""
+# Metadata of the videos probed by Video.compute_attrs, kept in vid
+VID_META = ['height','width','length','duration','frame_rate','codec',
+    'streams']
+IMG_DIFF_SQL = "INSERT OR REPLACE INTO img_diff (ida,idb,diff) VALUES (?,?,?)"
+PHASH_DIFF_SQL = """INSERT OR REPLACE INTO phash_diff (ida,idb,dist)
+VALUES (?,?,?)"""
+IDENTICAL_SQL = """INSERT OR REPLACE INTO comparator_identical
+(ida,idb,score,offset) VALUES (?,?,?,?)"""
+INCLUDED_SQL = """INSERT OR REPLACE INTO comparator_included_v1
+(ida,idb,rgb_1d_score,rgb_1d_offset) VALUES (?,?,?,?)"""
+SHOT_SQL = "INSERT INTO shot_index (key,id,frame) VALUES (?,?,?)"
+# Results of the comparators: table, value column and order of the best
+# pairs first (see comparison_report)
+REPORTS = {'images':('img_diff','diff','ASC'),
+    'phash':('phash_diff','dist','ASC'),
+    'identical':('comparator_identical','score','DESC'),
+    'included':('comparator_included_v1','rgb_1d_score','DESC')}
 
 
 # Functions to be called in a multiprocess fashion
 def mkargs_file(f):
-  return (f.path,f.qhash,f.size,f.type,f.hash)
+  if f.mtime is None:
+    f.compute_stat()
+  return (f.path,f.qhash,f.size,f.type,f.hash,f.mtime,f.inode,f.dev,
+      f.hash_algo)
+
+
+def rehash(f):
+  """
+  Returns (mkargs_file,None) for Database.rehash_outdated,
+  or ((path,),error) if the file cannot be read any more
+  """
+  try:
+    return mkargs_file(f),None
+  except OSError as e: # Removed since the last scan
+    return (f.path,),str(e)
 
 
 def mkargs_img(f):
-  return (f.path,f.height,f.width,int(f.r*256),
+  return (f.id,f.height,f.width,int(f.r*256),
     int(f.g*256),int(f.b*256),
-    None if f.signature is None else f.signature.tobytes())
+    None if f.signature is None else f.signature.tobytes(),
+    None if f.signature is None else f.grid,
+    f.phash)
 
 
 def mkargs_vid(f):
-  # Updating the signature will not be done when adding many files
-  # (RAM would be limiting, so useless)
-  #if f.signature is not None:
-  #  os.makedirs(os.path.dirname(f.signature_path),exist_ok=True)
-  #  np.save(f.signature_path,f.signature)
-  return (f.path,f.height,f.width,f.length,
-    None if f.sigrgb is None else f.sigrgb.tobytes())
+  # The full signature is already in the store (see compute_signatures)
+  return (f.id,f.height,f.width,f.length,
+    None if f.sigrgb is None else f.sigrgb.tobytes(),
+    None if f.shots is None else f.shots.astype(np.uint32).tobytes(),
+    *(f.location or (None,None,None)),
+    f.duration,f.frame_rate,f.codec,f.streams,*(f.probed or (None,None)),
+    f.sig_mode,f.sig_error)
 
 
 def mk_video_sig(f):
   f.compute_signatures()
-  return f
+  return mkargs_vid(f)
 
 
 def mk_image_sig(f):
   f.compute_signature()
-  return f
+  return mkargs_img(f)
 
 
-def get_all_files(d):
+def reuse_probes(l,probed):
   """
-  Get all the files in the folder (recursively)
+  Yields the files of l, with the metadata of the videos that were
+  already probed and did not change since (same size and mtime), given
+  by Database._probed_videos, so that they are not probed again
   """
-  r = []
-  absd = os.path.abspath(d)
-  l = os.listdir(absd)
   for f in l:
-    full = os.path.join(absd,f)
-    if os.path.isdir(full):
-      r += get_all_files(full)
-    else:
-      r.append(full)
-  return r
+    r = probed.get(f.path) if f.type == VIDEO else None
+    if r is not None:
+      if f.mtime is None:
+        f.compute_stat()
+      if (f.size,f.mtime) == r[0]:
+        f.set_attrs(r[0],**r[1])
+    yield f
+
+
+def mk_sig(f):
+  """
+  Computes the signatures of an image or video, returns (type,row)
+  """
+  if f.type == IMAGE:
+    return IMAGE,mk_image_sig(f)
+  return VIDEO,mk_video_sig(f)
+
+
+def run_io(func,t):
+  """
+  Runs func on the item of a (dev,item) tuple, returns (dev,result)
+  (see Database._imap_io)
+  """
+  dev,item = t
+  return dev,func(item)
+
+
+def read_qhash(f):
+  """
+  Returns the File with its qhash computed (see Database._scan),
+  or None if it cannot be read any more
+  """
+  try:
+    f.qhash
+  except OSError: # Removed since the scan
+    return None
+  return f
+
+
+def io_key(f):
+  """
+  Returns (path,dev,inode) of a File for the IOScheduler
+  """
+  if f.dev is None:
+    f.compute_stat()
+  return f.path,f.dev,f.inode
+
+
+def ingest(f,signatures=False):
+  """
+  Does all the processing of a new file for add_files: hashes, media
+  attributes and signatures if signatures is True
+
+  Returns (mkargs_file, mkargs_img or mkargs_vid or None)
+  """
+  row = mkargs_file(f)
+  if f.type == IMAGE:
+    return row,mk_image_sig(f) if signatures else mkargs_img(f)
+  elif f.type == VIDEO:
+    return row,mk_video_sig(f) if signatures else mkargs_vid(f)
+  return row,None
 
 
 class Database:
@@ -65,10 +195,352 @@ class Database:
   Can process the files given in the directory specified inconfig file,
   compare them and find duplicates in many different ways
   """
-  def __init__(self,config_file):
+  def __init__(self,config_file,processes=None):
     self.config_file = config_file
+    self.processes = processes or cpu_count()
     self.cfg = Config(config_file)
-    self.db = sqlite3.connect(self.cfg.db_file)
+    get_hash(self.cfg.hash_algo) # Fails early if it is not available
+    self.hash_version = hash_version(self.cfg.hash_algo,self.cfg.hash_bs)
+    self._pool = None
+    self._filter = None # See lookup_filter
+    # Several processes can write (see process_jobs), wait for the locks
+    self.db = sqlite3.connect(self.cfg.db_file,timeout=60)
+    # WAL: readers are not blocked by the writes and commits are cheaper
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self._upgrade_schema()
+
+  @property
+  def pool(self):
+    """
+    The worker processes, started on first use and shared by all the steps
+    """
+    if self._pool is None:
+      self._pool = Pool(self.processes)
+    return self._pool
+
+  def _imap(self,func,l,chunksize=1):
+    """
+    Runs func on the items of the iterable l in the pool and yields the
+    results as they come
+
+    Items are taken from l only when less than 4*chunksize tasks per
+    process are pending, so l can be a slow generator (like the walk)
+    and the memory usage remains bounded
+    """
+    sem = threading.Semaphore(4*chunksize*self.processes)
+    stop = False
+    def feed():
+      for item in l:
+        sem.acquire()
+        if stop:
+          return
+        yield item
+    try:
+      for r in self.pool.imap_unordered(func,feed(),chunksize):
+        sem.release()
+        yield r
+    finally: # Do not leave the feeder blocked if we stopped early
+      stop = True
+      sem.release()
+
+  def _imap_media(self,func,l):
+    """
+    Same as _imap for the tasks computing the signatures (File objects):
+    the images are sent by chunks, the videos one at a time once all the
+    images are done (a chunk holding a video would hold back the images
+    queued behind it), the longest first (see compute_video_signature)
+    """
+    videos = []
+    def images():
+      for f in l:
+        if f.type == VIDEO:
+          videos.append(f)
+        else:
+          yield f
+    yield from self._imap(func,images(),16)
+    yield from self._imap(func,sorted(videos,key=lambda f:-f.cost))
+
+  def _imap_io(self,func,l):
+    """
+    Same as _imap for the tasks reading files (File objects): the files
+    are read in the order of their location on each device, and only
+    io_hdd files of a spinning disk (io_ssd of the other devices, the
+    number of processes if None) are read at once (see iosched.IOScheduler)
+    """
+    sched = IOScheduler(l,io_key,self.cfg.io_hdd,
+        self.processes if self.cfg.io_ssd is None else self.cfg.io_ssd)
+    try:
+      for dev,r in self.pool.imap_unordered(partial(run_io,func),
+          sched.items()):
+        sched.done(dev)
+        yield r
+    finally: # Do not leave the feeder waiting if we stopped early
+      sched.stop()
+
+  @property
+  def store(self):
+    """
+    The store of the full video signatures (see store.Store)
+    """
+    return get_store(self.cfg.vid_library,(Y,X,3))
+
+  def _stop_pool(self):
+    """
+    Stops the worker processes (they are started again when needed)
+    """
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+  def close(self):
+    """
+    Stops the worker processes and closes the db
+    """
+    self._stop_pool()
+    self.store.close()
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*_):
+    self.close()
+
+  def _upgrade_schema(self):
+    """
+    Adds the columns missing in databases created by older versions
+    """
+    cur = self.db.cursor()
+    cur.execute("PRAGMA table_info(files)")
+    cols = [r[1] for r in cur.fetchall()]
+    if not cols: # Not created yet
+      return
+    for c in ['mtime','inode','dev']:
+      if c not in cols:
+        cur.execute(f"ALTER TABLE files ADD COLUMN {c} INT")
+    if 'hash_algo' not in cols:
+      cur.execute("ALTER TABLE files ADD COLUMN hash_algo TEXT")
+      # The older versions always used MD5 with 1MiB blocks
+      cur.execute("UPDATE files SET hash_algo = ?",(hash_version('md5',M),))
+    cur.execute("PRAGMA table_info(img)")
+    cols = [r[1] for r in cur.fetchall()]
+    if 'grid' not in cols:
+      cur.execute("ALTER TABLE img ADD COLUMN grid INT")
+      # The older versions only made 3x3 signatures
+      cur.execute("UPDATE img SET grid = 3 WHERE signature IS NOT NULL")
+    if 'phash' not in cols: # Computed by compute_image_signature
+      cur.execute("ALTER TABLE img ADD COLUMN phash INT")
+    cur.execute("PRAGMA table_info(vid)")
+    cols = [r[1] for r in cur.fetchall()]
+    if 'shots' not in cols:
+      # Computed by compute_video_signature
+      cur.execute("ALTER TABLE vid ADD COLUMN shots BLOB")
+    if 'sig_pack' not in cols:
+      cur.execute("ALTER TABLE vid ADD COLUMN sig_pack TEXT")
+      cur.execute("ALTER TABLE vid ADD COLUMN sig_offset INT")
+      cur.execute("ALTER TABLE vid ADD COLUMN sig_length INT")
+      self._import_npy()
+    if 'probe_size' not in cols:
+      # Filled when the videos are probed again (see Video.compute_attrs)
+      cur.execute("ALTER TABLE vid ADD COLUMN duration REAL")
+      cur.execute("ALTER TABLE vid ADD COLUMN frame_rate REAL")
+      cur.execute("ALTER TABLE vid ADD COLUMN codec TEXT")
+      cur.execute("ALTER TABLE vid ADD COLUMN streams INT")
+      cur.execute("ALTER TABLE vid ADD COLUMN probe_size INT")
+      cur.execute("ALTER TABLE vid ADD COLUMN probe_mtime INT")
+    if 'sig_mode' not in cols: # The older versions decoded all the frames
+      cur.execute("ALTER TABLE vid ADD COLUMN sig_mode TEXT")
+      cur.execute("UPDATE vid SET sig_mode = 'full' WHERE sig_pack IS NOT NULL")
+    if 'sig_error' not in cols:
+      cur.execute("ALTER TABLE vid ADD COLUMN sig_error TEXT")
+    cur.execute("PRAGMA table_info(jobs)")
+    cols = [r[1] for r in cur.fetchall()]
+    if cols and 'cost' not in cols:
+      cur.execute("ALTER TABLE jobs ADD COLUMN cost REAL")
+    self._create_indexes()
+    self._create_comparison_tables()
+    self._create_shot_index()
+    self._create_job_table()
+    self.db.commit()
+
+  def _create_indexes(self):
+    """
+    Creates the indexes of the tables if they do not exist
+
+    path is already indexed by its UNIQUE constraint
+    """
+    cur = self.db.cursor()
+    cur.execute("CREATE INDEX IF NOT EXISTS files_size ON files(size,qhash)")
+    cur.execute("CREATE INDEX IF NOT EXISTS files_qhash ON files(qhash)")
+    cur.execute("CREATE INDEX IF NOT EXISTS files_hash ON files(hash)")
+    # One index per part of the perceptual hash (see find_phash)
+    for i in range(phash.PARTS):
+      cur.execute(f"""CREATE INDEX IF NOT EXISTS img_phash{i}
+      ON img({phash.part_sql(i)})""")
+
+  def _create_comparison_tables(self):
+    """
+    Creates the tables holding the results of the comparators
+
+    Each pair is stored once, with ida < idb
+    """
+    cur = self.db.cursor()
+    # == TABLE img_diff: pairs of similar images (see compare_images) ==
+    # diff: average absolute difference of the signatures (0-255)
+    cur.execute("""CREATE TABLE IF NOT EXISTS img_diff(
+    ida INTEGER CHECK (ida < idb),
+    idb INTEGER CHECK (ida < idb),
+    diff REAL,
+    UNIQUE (ida,idb));""")
+    # == TABLE phash_diff: pairs of images with close perceptual hashes
+    # (see compare_phash) ==
+    # dist: number of different bits of the hashes
+    cur.execute("""CREATE TABLE IF NOT EXISTS phash_diff(
+    ida INTEGER CHECK (ida < idb),
+    idb INTEGER CHECK (ida < idb),
+    dist INT,
+    UNIQUE (ida,idb));""")
+    # == TABLE comparator_identical: pairs of videos with the same content
+    # (see compare_videos) ==
+    # score: normalized cross-correlation of the sigrgb (-1 to 1)
+    # offset: in seconds, idb at time t matches ida at time t+offset
+    cur.execute("""CREATE TABLE IF NOT EXISTS comparator_identical(
+    ida INTEGER CHECK (ida < idb),
+    idb INTEGER CHECK (ida < idb),
+    score REAL,
+    offset REAL,
+    UNIQUE (ida,idb));""")
+    # == TABLE comparator_included_v1: videos contained in longer ones ==
+    # rgb_1d_score, rgb_1d_offset: same as score and offset above
+    # match_score, match_offset: from a finer comparison (not computed yet)
+    cur.execute("""CREATE TABLE IF NOT EXISTS comparator_included_v1(
+    ida INTEGER CHECK (ida < idb),
+    idb INTEGER CHECK (ida < idb),
+    rgb_1d_score REAL,
+    rgb_1d_offset REAL,
+    match_score REAL,
+    match_offset REAL,
+    UNIQUE (ida,idb));""")
+    # Covering indexes: the pairs of a file (ida is indexed by UNIQUE) and
+    # the pairs by value are read from the index only
+    for table,col,_ in REPORTS.values():
+      cur.execute(f"""CREATE INDEX IF NOT EXISTS {table}_idb
+      ON {table}(idb,ida,{col})""")
+      cur.execute(f"""CREATE INDEX IF NOT EXISTS {table}_{col}
+      ON {table}({col},ida,idb)""")
+    # == TABLE comparison_state: progress of the comparators (see
+    # comparisons.ComparisonState) ==
+    # comparator: images, phash or videos
+    # params: parameters of the last run
+    # watermark: the files up to this id were compared with each other
+    cur.execute("""CREATE TABLE IF NOT EXISTS comparison_state(
+    comparator TEXT PRIMARY KEY,
+    params TEXT,
+    watermark INTEGER);""")
+    # == TABLE comparison_stale: files below the watermark of a comparator
+    # whose signature changed, to compare again ==
+    cur.execute("""CREATE TABLE IF NOT EXISTS comparison_stale(
+    comparator TEXT,
+    id INTEGER,
+    PRIMARY KEY (comparator,id)) WITHOUT ROWID;""")
+    # The pairs of a file are removed when its signature changes or when
+    # it is removed, and the pairs added to known_diff
+    # (no OR IGNORE: the conflict policy of the outer statement prevails)
+    stale = """INSERT INTO comparison_stale (comparator,id)
+      SELECT comparator,new.id FROM comparison_state s
+      WHERE comparator IN ({}) AND watermark >= new.id AND NOT EXISTS
+      (SELECT 1 FROM comparison_stale WHERE comparator = s.comparator
+      AND id = new.id);"""
+    pairs = "DELETE FROM {} WHERE ida = {id} OR idb = {id};"
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS img_signature_stale
+    AFTER UPDATE OF signature,grid ON img WHEN
+    old.signature IS NOT new.signature OR old.grid IS NOT new.grid BEGIN
+      {stale.format("'images'")}
+      {pairs.format('img_diff',id='new.id')}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS img_phash_stale
+    AFTER UPDATE OF phash ON img WHEN old.phash IS NOT new.phash BEGIN
+      {stale.format("'phash'")}
+      {pairs.format('phash_diff',id='new.id')}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS img_insert_stale
+    AFTER INSERT ON img BEGIN
+      {stale.format("'images','phash'")}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS vid_sigrgb_stale
+    AFTER UPDATE OF sigrgb ON vid WHEN old.sigrgb IS NOT new.sigrgb BEGIN
+      {stale.format("'videos'")}
+      {pairs.format('comparator_identical',id='new.id')}
+      {pairs.format('comparator_included_v1',id='new.id')}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS vid_insert_stale
+    AFTER INSERT ON vid BEGIN
+      {stale.format("'videos'")}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS files_delete_pairs
+    AFTER DELETE ON files BEGIN
+      {' '.join(pairs.format(t,id='old.id') for t,_,_ in REPORTS.values())}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS known_diff_pairs
+    AFTER INSERT ON known_diff BEGIN
+      {' '.join(f"DELETE FROM {t} WHERE ida = new.f1 AND idb = new.f2;"
+          for t,_,_ in REPORTS.values())}
+    END""")
+
+  def _create_shot_index(self):
+    """
+    Creates the inverted index of the shots of the videos
+
+    The entries of a video are removed by triggers when its shots change
+    or when it is deleted, and added back by _index_shots
+    """
+    cur = self.db.cursor()
+    # == TABLE shot_index: keys of the shots of the videos ==
+    # key: gaps between consecutive cuts (see video_match.shot_keys)
+    # id: id of the video
+    # frame: frame of the first cut of the key in the full signature
+    cur.execute("""CREATE TABLE IF NOT EXISTS shot_index(
+    key INTEGER,
+    id INTEGER,
+    frame INTEGER);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS shot_index_key
+    ON shot_index(key,id,frame)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS shot_index_id ON shot_index(id)")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS vid_shots_update
+    AFTER UPDATE OF shots ON vid BEGIN
+    DELETE FROM shot_index WHERE id = OLD.id; END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS vid_shots_delete
+    AFTER DELETE ON vid BEGIN
+    DELETE FROM shot_index WHERE id = OLD.id; END""")
+
+  def _create_job_table(self):
+    """
+    Creates the queue of the signatures to compute (see jobs.JobQueue)
+
+    The jobs of a file are removed by a trigger when it is deleted
+    """
+    cur = self.db.cursor()
+    # == TABLE jobs: signatures to compute by the workers ==
+    # id: id of the file
+    # type: type of the file (1: image, 2: video)
+    # worker: name of the worker holding the lease (NULL if available)
+    # expires: end of the lease (unix time)
+    # tries: number of times the job was claimed
+    # cost: expected cost (see _missing_signatures)
+    cur.execute("""CREATE TABLE IF NOT EXISTS jobs(
+    id INTEGER PRIMARY KEY,
+    type INT NOT NULL,
+    cost REAL,
+    worker TEXT,
+    expires REAL,
+    tries INT NOT NULL DEFAULT 0);""")
+    cur.execute("CREATE INDEX IF NOT EXISTS jobs_worker ON jobs(worker)")
+    cur.execute("CREATE INDEX IF NOT EXISTS jobs_cost ON jobs(type,cost)")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS files_delete_jobs
+    AFTER DELETE ON files BEGIN
+    DELETE FROM jobs WHERE id = OLD.id; END""")
 
   def reset(self):
     """
@@ -78,6 +550,7 @@ class Database:
       print("Cancelled")
       raise Exception("Aborted")
     print("Erasing...",end='',flush=True)
+    self.store.close()
     if os.path.exists(self.cfg.vid_library):
       rmtree(self.cfg.vid_library)
     os.makedirs(self.cfg.vid_library)
@@ -86,17 +559,33 @@ class Database:
     cur.execute("DROP TABLE IF EXISTS img")
     cur.execute("DROP TABLE IF EXISTS vid")
     cur.execute("DROP TABLE IF EXISTS known_diff")
+    cur.execute("DROP TABLE IF EXISTS img_diff")
+    cur.execute("DROP TABLE IF EXISTS phash_diff")
+    cur.execute("DROP TABLE IF EXISTS comparator_identical")
+    cur.execute("DROP TABLE IF EXISTS comparator_included_v1")
+    cur.execute("DROP TABLE IF EXISTS comparison_state")
+    cur.execute("DROP TABLE IF EXISTS comparison_stale")
+    cur.execute("DROP TABLE IF EXISTS shot_index")
+    cur.execute("DROP TABLE IF EXISTS jobs")
     # == TABLE files: contains all the files ==
     # path: Path of the file
     # qhash: quick hash of the file (mandatory)
     # Type: image, video or none (0: non-media, 1: image, 2: video)
     # hash: complete hash
+    # mtime, inode, dev: from stat, to detect changes when rescanning
+    #   (mtime is in ns)
+    # hash_algo: algorithm and block size used for qhash and hash
+    #   (see hashing.hash_version)
     cur.execute("""CREATE TABLE files(id INTEGER PRIMARY KEY,
     path TEXT UNIQUE,
     qhash BLOB NOT NULL,
     size INT,
     type INT NOT NULL,
-    hash BLOB);""")
+    hash BLOB,
+    mtime INT,
+    inode INT,
+    dev INT,
+    hash_algo TEXT);""")
     # == TABLE img : Contains metadata specific for images ==
     # id: id of the corresponding file
     # height, width: resolution of the image
@@ -107,51 +596,96 @@ class Database:
     #   Note : r,g and b are non-integer values between 0 and 255.
     #          They are stored as int(256*val)
     # signature: image signature for quick comparison
+    # grid: size of the evaluation grid of the signature
+    #   (signature is a (grid,grid,3) uint16 array)
+    # phash: 64 bits perceptual hash (see phash.dhash), as a signed int
     cur.execute("""CREATE TABLE img(id INTEGER PRIMARY KEY,
     height INT,
     width INT,
     r INT,
     g INT,
     b INT,
-    signature BLOB);""")
+    signature BLOB,
+    grid INT,
+    phash INT);""")
     # == TABLE vid : Contains metadata specific for videos ==
     # id: id of the corresponding file
     # height, width: resolution of the video
     # length: length in seconds
     # sigrgb: (t,3) array of color over time
+    # shots: uint32 array of the frames of the full signature starting
+    #   a new shot (see video.find_cuts)
+    # sig_pack, sig_offset, sig_length: location of the full signature
+    #   in the store (see store.Store)
+    # duration: exact length in seconds
+    # frame_rate, codec: of the first video stream
+    # streams: number of streams of the file (NULL if it could not be probed)
+    # probe_size, probe_mtime: size and mtime of the file when it was
+    #   probed, the metadata is reused while they do not change (NULL if
+    #   the probe failed: the video is probed again)
+    # sig_mode: mode of the signatures, 'full' or 'keyframes'
+    #   (see video.read_frames)
+    # sig_error: error of the last computation of the signatures, they are
+    #   not computed again unless asked for (see failed_signatures)
     cur.execute("""CREATE TABLE vid(id INTEGER PRIMARY KEY,
     height INT,
     width INT,
     length INT,
-    sigrgb BLOB);""")
+    sigrgb BLOB,
+    shots BLOB,
+    sig_pack TEXT,
+    sig_offset INT,
+    sig_length INT,
+    duration REAL,
+    frame_rate REAL,
+    codec TEXT,
+    streams INT,
+    probe_size INT,
+    probe_mtime INT,
+    sig_mode TEXT,
+    sig_error TEXT);""")
     # == TABLE known_diff: To allow the user to specify manually files that
     # are known to be different
     cur.execute("""CREATE TABLE known_diff(
     f1 INTEGER CHECK (f1 < f2),
     f2 INTEGER CHECK (f1 < f2),
     UNIQUE (f1,f2));""")
+    self._create_indexes()
+    self._create_comparison_tables()
+    self._create_shot_index()
+    self._create_job_table()
     print("OK!")
 
   def _get_npy_path(self,fname):
     """
     Returns the path of the npy file containing the video signature
+    in the older versions (see _import_npy)
     """
     return self.cfg.vid_library+fname[
         len(os.path.abspath(self.cfg.root_dir)):]+'.npy'
 
-  def new_file(self,fname):
+  def new_file(self,fname,**kwargs):
     """
     Returns a new File object
 
     Will NOT check if it exists in the DB
+    kwargs are given to the constructor (to pass the known stat values)
     """
+    kwargs['hash_algo'] = self.hash_version
     t = self.get_type(fname)
     if t == NOMEDIA:
-      return File(fname)
+      return File(fname,**kwargs)
     elif t == IMAGE:
-      return Image(fname)
+      return Image(fname,grid=self.cfg.img_grid,**kwargs)
     elif t == VIDEO:
-      return Video(fname,signature_path=self._get_npy_path(fname))
+      return Video(fname,**self._video_kwargs(),**kwargs)
+
+  def _video_kwargs(self):
+    """
+    Settings of the config given to the Video objects
+    """
+    return dict(store=self.cfg.vid_library,mode=self.cfg.vid_mode,
+        timeout=self.cfg.sig_timeout,max_memory=self.cfg.sig_max_memory)
 
   def get_file(self,fname):
     """
@@ -159,36 +693,78 @@ class Database:
 
     Returns None if not found
     """
+    l = self.get_files([fname])
+    return l[0] if l else None
+
+  def get_files(self,l:List[str]):
+    """
+    Returns the File objects of the names of the list that are in the db,
+    in the same order
+
+    The rows of files, img and vid are read in one query each
+    per 500 names
+    """
     cur = self.db.cursor()
-    cur.execute("SELECT id,qhash,size,type,hash FROM files WHERE path = ?",
-        (fname,))
-    r = cur.fetchone()
-    if not r:
-      return
-    d = dict((k,v) for k,v in zip(['qhash','size','type','hash'],r[1:]))
+    out = []
+    for i in range(0,len(l),500): # SQLite limits the number of args
+      chunk = l[i:i+500]
+      args = ','.join(['?' for f in chunk])
+      cur.execute(f"""SELECT path,id,qhash,size,type,hash,hash_algo FROM files
+      WHERE path IN ({args})""",chunk)
+      files = dict((r[0],r[1:]) for r in cur.fetchall())
+      cur.execute(f"""SELECT i.id,i.height,i.width,i.r,i.g,i.b,i.signature,
+      i.grid,i.phash FROM img i JOIN files f ON f.id = i.id
+      WHERE f.path IN ({args})""",chunk)
+      img = dict((r[0],r[1:]) for r in cur.fetchall())
+      cur.execute(f"""SELECT v.id,v.sig_mode,v.sig_error,v.sigrgb,v.shots,
+      v.sig_pack,v.sig_offset,v.sig_length,v.probe_size,v.probe_mtime,
+      {','.join('v.'+c for c in VID_META)} FROM vid v JOIN files f
+      ON f.id = v.id WHERE f.path IN ({args})""",chunk)
+      vid = dict((r[0],r[1:]) for r in cur.fetchall())
+      for fname in chunk:
+        r = files.get(fname)
+        if r is not None:
+          out.append(self._make_file(fname,r,img.get(r[0]),vid.get(r[0])))
+    return out
+
+  def _make_file(self,fname,r,img=None,vid=None):
+    """
+    Returns a File object given its rows of files, img and vid
+    (as read by get_files)
+    """
+    d = dict(zip(['id','qhash','size','type','hash','hash_algo'],r))
     t = d.pop('type')
     if t == IMAGE:
-      cur.execute("""SELECT * FROM img WHERE id =
-      (SELECT id FROM files WHERE path = ?)""",(fname,))
-      r = cur.fetchone()
-      h,w,r,g,b,s = r[1:]
-      sig = s if s is None else np.frombuffer(
-          s,dtype=np.uint16).reshape(3,3,3)
-      d['height'],d['width'] = h,w
-      d['brightness'] = (r,g,b)
-      d['signature'] = sig
+      if img is not None:
+        h,w,r,g,b,s,grid,d['phash'] = img
+        sig = s if s is None else np.frombuffer(
+            s,dtype=np.uint16).reshape(grid,grid,3)
+        d['height'],d['width'] = h,w
+        d['brightness'] = (r/256,g/256,b/256)
+        d['signature'] = sig
+        d['grid'] = grid
       return Image(fname,**d)
     elif t == VIDEO:
-      cur.execute("""SELECT * FROM vid WHERE id =
-      (SELECT id FROM files WHERE path = ?)""",(fname,))
-      r = cur.fetchone()
-      h,w,l,s = r[1:]
-      sigrgb = s if s is None else np.frombuffer(
-          s,dtype=np.uint8).reshape(-1,3)
-      d['height'],d['width'] = h,w
-      d['length'] = l
-      d['sigrgb'] = sigrgb
-      return Video(fname,signature_path=self._get_npy_path(fname),**d)
+      if vid is not None:
+        d['sig_mode'],d['sig_error'],s,shots,*r = vid
+        location,probed = r[:3],r[3:5]
+        d.update(zip(VID_META,r[5:]))
+        d['probed'] = None if probed[0] is None else tuple(probed)
+        sigrgb = s if s is None else np.frombuffer(
+            s,dtype=np.uint8).reshape(-1,3)
+        d['sigrgb'] = sigrgb
+        d['shots'] = shots if shots is None else np.frombuffer(
+            shots,dtype=np.uint32)
+        d['location'] = None if location[0] is None else tuple(location)
+      return Video(fname,**self._video_kwargs(),**d)
+    return File(fname,**d)
+
+  def catalog(self,types=None,sigrgb=True):
+    """
+    Returns a catalog.Catalog of the db: its columns as arrays,
+    to work on all the files at once (see catalog.load)
+    """
+    return catalog.load(self.db,self.cfg.img_grid,types,sigrgb)
 
   def get_type(self,fname:str):
     """
@@ -202,100 +778,96 @@ class Database:
         return VIDEO
     return NOMEDIA
 
-  def add_files(self,l:List[File]):
+  def add_files(self,l:Iterable[File],signatures=False):
     """
-    Adds a list of files to the db
+    Adds files to the db
+
+    l can be a generator: the files are processed as soon as they are yielded
+    If a file is already in the db, its entry is replaced (keeping its id)
+    and its signatures are cleared, unless signatures is True: then
+    the signatures are computed along with the hashes and attributes
+
+    Each file is entirely processed by a single task of the pool, so the
+    reading of a file overlaps with the computations on the other ones
+    With signatures, the videos are processed after the images (see
+    _imap_media). Without signatures, the tasks only read a few blocks of each file:
+    the reads are scheduled by device (see _imap_io)
     """
-    if not l:
-      print("Nothing to add")
-      return
     print("Processing files")
-    self._insert_files(l)
-    img = [f for f in l if f.type == IMAGE]
-    if img:
-      print("Processing images")
-      self._insert_images(img)
-    else:
-      print("No images")
-    vid = [f for f in l if f.type == VIDEO]
-    if vid:
-      print("Processing videos")
-      self._insert_videos(vid)
+    probed = self._probed_videos()
+    cur = self.db.cursor()
+    # The ids below a watermark are never reused (see ComparisonState)
+    cur.execute("""SELECT max(m) FROM (SELECT max(id) AS m FROM files
+    UNION ALL SELECT max(watermark) FROM comparison_state)""")
+    next_id = (cur.fetchone()[0] or 0)+1
+    n = 0
+    with Writer(self.db) as w:
+      func,files = partial(ingest,signatures=signatures),reuse_probes(l,probed)
+      for n,(row,media) in enumerate(self._imap_media(func,files)
+          if signatures else self._imap_io(func,files),1):
+        print(f"\r{n} files processed",end='')
+        path,t = row[0],row[3]
+        cur.execute("SELECT id FROM files WHERE path = ?",(path,))
+        r = cur.fetchone()
+        if r is None:
+          fid,next_id = next_id,next_id+1
+        else:
+          fid = r[0]
+        w.add(FILE_SQL,(fid,)+row)
+        if self._filter is not None and row[8] == self.hash_version:
+          self._filter.add(row[2],row[1])
+        if t == IMAGE:
+          w.add(IMG_SQL,(fid,)+media[1:])
+        elif t == VIDEO:
+          w.add(VID_SQL,(fid,)+media[1:])
+    if not n:
+      print("Nothing to add")
     else:
-      print("No videos")
-    self.db.commit()
+      print()
 
-  def _insert_files(self,l):
+  def _probed_videos(self):
     """
-    Internal method used to update the tables db
+    Returns a dict {path: ((size,mtime),metadata)} of the videos that
+    were probed (see Video.compute_attrs)
     """
-    toadd = []
-    for i,v in enumerate(Pool(cpu_count()).imap_unordered(mkargs_file,l),1):
-      print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)",end='')
-      toadd.append(v)
-    cur = self.db.cursor()
-    print("\nAdding to db...",end='',flush=True)
-    cur.executemany("""INSERT INTO files (path,qhash,size,type,hash)
-    VALUES (?,?,?,?,?)""", toadd)
-    print("OK")
-
-  def _insert_images(self,l):
-    toadd = []
-    for i,v in enumerate(Pool(cpu_count()).imap_unordered(mkargs_img,l),1):
-      print(f"\r{i}/{len(l)} ({100*(i)/len(l):.2f}%)",end='')
-      toadd.append(v)
-    cur = self.db.cursor()
-    print("\nAdding to db...",end='',flush=True)
-    cur.executemany("""INSERT INTO img (id,height,width,r,g,b,signature)
-    VALUES ((SELECT id FROM files WHERE path = ?),?,?,?,?,?,?)""",toadd)
-    print("OK")
-
-  def _insert_videos(self,l):
-    toadd = []
-    for i,v in enumerate(Pool(cpu_count()).imap_unordered(mkargs_vid,l),1):
-      print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)",end='')
-      toadd.append(v)
-    cur = self.db.cursor()
-    print("\nAdding to db...",end='',flush=True)
-    cur.executemany("""INSERT INTO vid (id,height,width,length,sigrgb)
-    VALUES ((SELECT id FROM files WHERE path = ?),?,?,?,?)""",toadd)
-    print("OK")
-
-  #def get_file_id(self,fname):
-  #  """
-  #  Gets the id of a file given its path
-  #  """
-  #  cur = self.db.cursor()
-  #  cur.execute("SELECT id FROM files WHERE path = ?",(fname,))
-  #  try:
-  #    return cur.fetchone()[0]
-  #  except IndexError:
-  #    return None
+    cur = self.db.cursor()
+    cur.execute(f"""SELECT f.path,v.probe_size,v.probe_mtime,
+    {','.join('v.'+c for c in VID_META)} FROM vid v JOIN files f
+    ON f.id = v.id WHERE v.probe_size IS NOT NULL""")
+    return dict((r[0],(r[1:3],dict(zip(VID_META,r[3:]))))
+        for r in cur.fetchall())
+
+  def get_ids(self,l:List[str]):
+    """
+    Returns a dict {path: id} for the paths of the list that are in the db
+    """
+    cur = self.db.cursor()
+    d = {}
+    for i in range(0,len(l),500): # SQLite limits the number of args
+      chunk = l[i:i+500]
+      cur.execute(f"""SELECT path,id FROM files WHERE path IN
+          ({','.join(['?' for f in chunk])})""",chunk)
+      d.update(cur.fetchall())
+    return d
 
   def update_file(self,f:File):
     """
     Update an entry of the db
     """
     cur = self.db.cursor()
-    cur.execute("""UPDATE files SET
-      qhash = ?, size = ?, type = ?, hash = ? WHERE path = ?""",
-      (f.qhash, f.size,f.type, f.hash, f.path))
+    cur.execute("""UPDATE files SET qhash = ?, size = ?, type = ?, hash = ?,
+      mtime = ?, inode = ?, dev = ?, hash_algo = ? WHERE path = ?""",
+      mkargs_file(f)[1:]+(f.path,))
+    if f.id is None:
+      f.id = self.get_ids([f.path])[f.path]
     if f.type == IMAGE:
-      cur.execute("""UPDATE img SET
-        height = ?, width = ?, r = ?, g = ?, b = ?, signature = ?
-      WHERE id = (SELECT id FROM files WHERE path = ?)""",
-      (f.height,f.width,
-        int(f.r*256), int(f.g*256), int(f.b*256),
-        None if f.signature is None else f.signature.tobytes(),
-        f.path))
+      cur.execute(IMG_SQL,mkargs_img(f))
     elif f.type == VIDEO:
-      cur.execute("""UPDATE vid SET height = ?, width = ?, length = ?,
-      sigrgb = ? WHERE id = (SELECT id FROM files WHERE path = ?)""",
-      (f.height, f.width,
-      f.length, f.sigrgb, f.path))
-      if f.signature is not None:
-        os.makedirs(os.path.dirname(self._get_npy_path(f.path)),exist_ok=True)
-        np.save(self._get_npy_path(f.path),f.signature)
+      if f._signature is not None and f.location is None:
+        # Only if set in RAM, not read from the store
+        f.location = self.store.append(f._signature)
+        self.store.close() # Do not keep the pack locked between updates
+      cur.execute(VID_SQL,mkargs_vid(f))
     self.db.commit()
 
   def remove(self,fname:str):
@@ -308,52 +880,188 @@ class Database:
     cur.execute("""DELETE FROM vid WHERE id =
         (SELECT id FROM files WHERE path = ?)""",(fname,))
     cur.execute("DELETE FROM files WHERE path = ?",(fname,))
-    try:
-      os.remove(self._get_npy_path(fname))
-    except FileNotFoundError:
-      pass
     self.db.commit()
 
   def remove_many(self,l:List[str]):
     """
     Removes a list of path from the db
+
+    The space of the full video signatures is reclaimed by
+    compact_signatures
     """
     cur = self.db.cursor()
-    cur.execute(f"""DELETE FROM img WHERE id IN
-        (SELECT id FROM files WHERE path IN
-        ({','.join(['?' for f in l])}))""",l)
-    cur.execute(f"""DELETE FROM vid WHERE id IN
-        (SELECT id FROM files WHERE path IN
-        ({','.join(['?' for f in l])}))""",l)
-    cur.execute(f"""DELETE FROM files WHERE path IN
-        ({','.join(['?' for f in l])})""",l)
-    for name in l:
-      try:
-        os.remove(self._get_npy_path(name))
-      except FileNotFoundError:
-        pass
+    for i in range(0,len(l),500): # SQLite limits the number of args
+      chunk = l[i:i+500]
+      cur.execute(f"""DELETE FROM img WHERE id IN
+          (SELECT id FROM files WHERE path IN
+          ({','.join(['?' for f in chunk])}))""",chunk)
+      cur.execute(f"""DELETE FROM vid WHERE id IN
+          (SELECT id FROM files WHERE path IN
+          ({','.join(['?' for f in chunk])}))""",chunk)
+      cur.execute(f"""DELETE FROM files WHERE path IN
+          ({','.join(['?' for f in chunk])})""",chunk)
+    self.db.commit()
+
+  def _scan(self,r):
+    """
+    Walks the root_dir and compares the files with the db using only stat
+
+    Returns a generator yielding the paths that must be (re)hashed as soon
+    as they are found (new and modified files) and filling r (see scan)
+    New files with the stat or the size of a file of the db may have been
+    moved, they are only yielded at the end of the walk if they were not.
+    The qhashes read to find them are computed by the pool, the new
+    ones are given along in r['files'] so that they are not read again
+    """
+    cur = self.db.cursor()
+    cur.execute("SELECT path,size,mtime,inode,dev,qhash,hash_algo FROM files")
+    known,qhashes = {},{}
+    for row in cur.fetchall():
+      known[row[0]] = row[1:5]
+      if row[6] == self.hash_version:
+        qhashes[row[0]] = row[5]
+    keys = set(st for st in known.values() if st[1] is not None)
+    sizes = set(st[0] for st in known.values())
+    for k in ['new','unchanged','modified','deleted','moved','moved_qhash']:
+      r[k] = []
+    r['stat'] = disk = {}
+    r['files'] = {}
+    def gen():
+      maybe_moved = []
+      same_size = []
+      for f,st in walk(self.cfg.root_dir,self.cfg.exclusion,
+          self.cfg.walk_threads):
+        disk[f] = st
+        old = known.get(f)
+        if old is None:
+          if st in keys:
+            maybe_moved.append(f)
+          elif st[0] in sizes:
+            same_size.append(f)
+          else:
+            r['new'].append(f)
+            yield f
+        elif old == st or (old[1] is None and old[0] == st[0]):
+          # No mtime: added by an older version, trust the size
+          r['unchanged'].append(f)
+        else:
+          r['modified'].append(f)
+          yield f
+      gone = dict((st,f) for f,st in known.items()
+          if f not in disk and st[1] is not None)
+      for f in maybe_moved:
+        old = gone.pop(disk[f],None)
+        if old is None:
+          same_size.append(f)
+        else:
+          r['moved'].append((old,f))
+      moved = set(old for old,_ in r['moved'])
+      # Fallback for the files moved to another device or with another
+      # mtime: same size and quick hash as a file that disappeared
+      gone = {}
+      for f,st in known.items():
+        if f not in disk and f not in moved and f in qhashes:
+          gone.setdefault((st[0],qhashes[f]),[]).append(f)
+      gone_sizes = set(k[0] for k in gone)
+      check = [self.new_file(f,**dict(zip(['size','mtime','inode','dev'],
+        disk[f]))) for f in same_size if disk[f][0] in gone_sizes]
+      read = dict((g.path,g) for g in (self._imap_io(read_qhash,check)
+        if check else []) if g is not None)
+      for f in same_size:
+        old = None
+        if disk[f][0] in gone_sizes:
+          if f not in read: # Removed since
+            continue
+          old = gone.get((disk[f][0],read[f].qhash))
+        if old:
+          r['moved'].append((old.pop(),f))
+          r['moved_qhash'].append(f)
+          moved.add(r['moved'][-1][0])
+        else:
+          r['new'].append(f)
+          if f in read:
+            r['files'][f] = read[f]
+          yield f
+      r['deleted'] = [f for f in known if f not in disk and f not in moved]
+    return gen()
+
+  def scan(self):
+    """
+    Compares the files in the root_dir with the db using only stat
+
+    Returns a dict with the lists of paths:
+      new: not in the db
+      unchanged: same size, mtime, inode and device
+      modified: in the db, but with a different size or mtime
+      deleted: in the db but not in the root_dir
+      moved: (old,new) tuples of paths of the same file (same inode, device,
+        size and mtime, or else same size and qhash)
+      moved_qhash: the new paths of the files moved found by their qhash
+    And 'stat', a dict {path: stat_key} of all the files in the root_dir
+    and 'files', a dict {path: File} of the new files already read
+    """
+    r = {}
+    for _ in self._scan(r):
+      pass
+    return r
+
+  def move_many(self,l,stat=None):
+    """
+    Takes a list of (old,new) paths and updates the db accordingly
+
+    The hashes and signatures are kept (the signatures are stored by id)
+    stat is an optional dict {new path: stat_key} to update the stat
+    of the moved files
+    """
+    cur = self.db.cursor()
+    cur.executemany("UPDATE files SET path = ? WHERE path = ?",
+        [(new,old) for old,new in l])
+    if stat is not None:
+      cur.executemany("""UPDATE files SET size = ?, mtime = ?, inode = ?,
+      dev = ? WHERE path = ?""",[stat[new]+(new,) for _,new in l])
     self.db.commit()
 
-  def detect_and_add(self):
+  def detect_and_add(self,signatures=False):
     """
-    Detect all the files in the root_dir and add them to the db
+    Rescans the root_dir and updates the db
+
+    Only the new and modified files will be read, moved files are
+    updated and deleted files are removed from the db
+    If signatures is True, the signatures of the new and modified files
+    are computed at the same time (see add_files)
     """
-    flist = get_all_files(self.cfg.root_dir)
+    s = {}
+    # The files are processed during the walk
+    self.add_files((s['files'].pop(f,None) or self.new_file(f,**dict(zip(
+      ['size','mtime','inode','dev'],s['stat'][f]))) for f in self._scan(s)),
+      signatures)
+    print(f"{len(s['new'])} new, {len(s['modified'])} modified, "
+        f"{len(s['moved'])} moved, {len(s['deleted'])} deleted, "
+        f"{len(s['unchanged'])} unchanged")
+    # Update the stat data for the files added by older versions
     cur = self.db.cursor()
-    cur.execute("SELECT path FROM files")
-    r = [t[0] for t in cur.fetchall()]
-    new = [self.new_file(f) for f in flist if f not in r]
-    self.add_files(new)
+    cur.execute("SELECT path FROM files WHERE mtime IS NULL")
+    nostat = set(t[0] for t in cur.fetchall())
+    cur.executemany("UPDATE files SET mtime = ?, inode = ?, dev = ? "
+        "WHERE path = ?",
+        [s['stat'][f][1:]+(f,) for f in s['unchanged'] if f in nostat])
+    self.db.commit()
+    if s['moved']:
+      self.move_many(s['moved'],s['stat'])
+      # Only the quick hash was checked: the full hash is computed again
+      # when needed, unless the quick hash covers the whole file
+      cur.executemany("UPDATE files SET hash = NULL WHERE path = ? AND "
+          "size >= ?",[(f,3*self.cfg.hash_bs) for f in s['moved_qhash']])
+      self.db.commit()
+    if s['deleted']:
+      self.remove_many(s['deleted'])
+    self.rehash_outdated()
 
   def cleanup(self):
     """
     Remove all the files from the db that are not in the root_dir
     """
-    dblist = get_all_files(self.cfg.root_dir)
-    cur = self.db.cursor()
-    cur.execute("SELECT path FROM files")
-    flist = [t[0] for t in cur.fetchall()]
-    torm = [f for f in dblist if f not in flist]
+    torm = self.scan()['deleted']
     if not torm:
       print("Nothing to do")
       return
@@ -361,45 +1069,589 @@ class Database:
     self.remove_many(torm)
     print("Ok.")
 
-  def compute_video_signature(self,l=None):
+  def compute_video_signature(self,l=None,mode=None):
     """
     Compute the video signatures of the file names in the list
 
     If no list is given, compute all the missing vids
+    (and the ones without shots, made by older versions)
+    except the ones that failed (see failed_signatures)
+    mode is the mode of the fingerprints (see video.MODES), vid_mode
+    of the config by default
+    The longest videos are computed first, so that they do not end up
+    running alone at the end (see Video.cost). Each one is limited
+    to sig_timeout seconds and sig_max_memory MiB
     """
     if l is None:
-      cur = self.db.cursor()
-      cur.execute("""SELECT path FROM files WHERE id IN
-      (SELECT id FROM vid WHERE sigrgb IS NULL)""")
-      l = [t[0] for t in cur.fetchall()]
+      l = [t[1] for t in self._missing_signatures(VIDEO)]
     if not l:
       print("No video signature to compute")
       return
-    for i,f in enumerate(
-        Pool(4).imap_unordered(mk_video_sig,
-          [self.get_file(name) for name in l]),1):
-      print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)")
-      self.update_file(f)
+    files = sorted(self.get_files(l),key=lambda f:-f.cost)
+    for f in files:
+      f.mode = mode or self.cfg.vid_mode
+    # The signatures are streamed to the disk, the RAM is not limiting
+    with Writer(self.db) as w:
+      for i,row in enumerate(self._imap(mk_video_sig,files),1):
+        print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)")
+        w.add(VID_SQL,row)
 
   def compute_image_signature(self,l=None):
     """
     Compute the image signatures of the file names in the list
 
     If no list is given, compute all the missing signatures
+    and the ones made with another grid size than img_grid
+    or without perceptual hash (unless the image could not be read)
     """
     if l is None:
-      cur = self.db.cursor()
-      cur.execute("""SELECT path FROM files WHERE id IN
-      (SELECT id FROM img WHERE signature IS NULL)""")
-      l = [t[0] for t in cur.fetchall()]
+      l = [t[1] for t in self._missing_signatures(IMAGE)]
     if not l:
       print("No image signature to compute")
       return
-    for i,f in enumerate(
-        Pool(4).imap_unordered(mk_image_sig,
-          [self.get_file(name) for name in l]),1):
-      print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)")
-      self.update_file(f)
+    # The largest first (see compute_video_signature)
+    files = sorted(self.get_files(l),key=lambda f:-f.size)
+    for f in files:
+      f.grid = self.cfg.img_grid
+    with Writer(self.db) as w:
+      for i,row in enumerate(self._imap(mk_image_sig,files,4),1):
+        print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)")
+        w.add(IMG_SQL,row)
+
+  def _missing_signatures(self,t):
+    """
+    Returns a list of (id,path,cost) of the files of type t (IMAGE or
+    VIDEO) with signatures to compute (see compute_*_signature),
+    the most expensive first
+
+    The cost is the size of the images and the one of Video.cost
+    for the videos
+    """
+    cur = self.db.cursor()
+    if t == IMAGE:
+      cur.execute("""SELECT f.id,f.path,f.size FROM files f JOIN img i
+      ON i.id = f.id WHERE i.signature IS NULL OR i.grid != ?
+      OR (i.phash IS NULL AND i.width > 0) ORDER BY f.size DESC""",
+      (self.cfg.img_grid,))
+    else:
+      cur.execute("""SELECT f.id,f.path,COALESCE(NULLIF(v.duration,0),
+      NULLIF(v.length,0),f.size/1048576.0) AS cost FROM files f JOIN vid v
+      ON v.id = f.id WHERE (v.sigrgb IS NULL OR v.shots IS NULL
+      OR v.sig_pack IS NULL) AND v.sig_error IS NULL ORDER BY cost DESC""")
+    return cur.fetchall()
+
+  def failed_signatures(self):
+    """
+    Returns a dict {path: error} of the videos whose signatures could
+    not be computed
+
+    They are computed again only if given to compute_video_signature
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT f.path,v.sig_error FROM files f JOIN vid v
+    ON v.id = f.id WHERE v.sig_error IS NOT NULL""")
+    return dict(cur.fetchall())
+
+  def queue_signatures(self):
+    """
+    Adds all the missing image and video signatures to the job queue,
+    to be computed by process_jobs (possibly on other machines)
+
+    Returns the number of jobs added
+    """
+    q = JobQueue(self.db)
+    n = self.db.total_changes
+    for t in (IMAGE,VIDEO):
+      q.add([(i,c) for i,_,c in self._missing_signatures(t)],t)
+    return self.db.total_changes-n
+
+  def process_jobs(self,batch=16,lease=300,wait=0,remap=None):
+    """
+    Computes the signatures of the job queue (see queue_signatures)
+    until it is empty, by batches of batch files
+
+    Several workers can run at the same time, on the same machine or on
+    other ones sharing the db, the root_dir and the vid_library.
+    The jobs of a worker that stopped are given to the other ones after
+    lease seconds. If wait is not 0, the worker waits for them (checking
+    every wait seconds) instead of stopping while other workers run
+    remap is an optional (old,new) tuple to replace the prefix old of the
+    paths of the db by new (if the files are mounted elsewhere)
+    Returns the number of files processed
+    """
+    q = JobQueue(self.db,lease)
+    worker = worker_name()
+    hb = Heartbeat(self.cfg.db_file,worker,lease)
+    hb.start()
+    n = 0
+    try:
+      while True:
+        jobs = q.claim(worker,batch)
+        if not jobs:
+          if wait and q.status()['running']:
+            sleep(wait)
+            continue
+          break
+        cur = self.db.cursor()
+        cur.execute(f"""SELECT path FROM files WHERE id IN
+        ({','.join(['?' for _ in jobs])})""",[i for i,_ in jobs])
+        # The files deleted since they were queued are skipped
+        files = sorted(self.get_files([t[0] for t in cur.fetchall()]),
+            key=lambda f:-(f.cost if f.type == VIDEO else f.size))
+        for f in files:
+          if remap is not None and f.path.startswith(remap[0]):
+            f.path = remap[1]+f.path[len(remap[0]):]
+          if f.type == IMAGE:
+            f.grid = self.cfg.img_grid
+        with Writer(self.db) as w:
+          for t,row in self._imap(mk_sig,files):
+            w.add(IMG_SQL if t == IMAGE else VID_SQL,row)
+        q.done(i for i,_ in jobs)
+        n += len(jobs)
+        print(f"[{worker}] {n} files processed")
+    finally:
+      hb.stop()
+      q.release(worker)
+    return n
+
+  def compare_images(self,max_diff=8,max_ratio_diff=0.05,full=False):
+    """
+    Finds the similar images and saves them in the img_diff table
+
+    Only the signatures made with the current img_grid are compared and
+    the pairs in known_diff are skipped (see image_match.similar_pairs
+    for the parameters)
+    Only the images added or modified since the last run with the same
+    parameters are compared with the other ones (see ComparisonState),
+    unless full is True: then the previous results are replaced
+    Returns the number of pairs found
+    """
+    state = ComparisonState(self.db)
+    watermark = state.watermark()
+    params = repr((max_diff,max_ratio_diff,self.cfg.img_grid))
+    c = self.catalog([IMAGE])
+    rows = np.nonzero((c.sig_row >= 0) & (c.width > 0) & (c.height > 0))[0]
+    new = None if full else state.new('images',params,c.id[rows])
+    cur = self.db.cursor()
+    cur.execute("SELECT f1,f2 FROM known_diff")
+    known = set(cur.fetchall())
+    if new is None:
+      cur.execute("DELETE FROM img_diff")
+    n = 0
+    if len(rows) >= 2 and (new is None or new.any()):
+      # All the signatures in a single contiguous matrix
+      ids = c.id[rows]
+      sizes = np.stack([c.width[rows],c.height[rows]],axis=1).astype(
+          np.float64)
+      brightness = c.brightness[rows]
+      sigs = c.signatures[c.sig_row[rows]].reshape(len(rows),-1).astype(
+          np.float32)/256
+      del c
+      with Writer(self.db) as w:
+        for ida,idb,diff in similar_pairs(ids,sizes,brightness,sigs,
+            max_diff,max_ratio_diff,new=new):
+          for row in zip(ida.tolist(),idb.tolist(),diff.tolist()):
+            if row[:2] not in known:
+              w.add(IMG_DIFF_SQL,row)
+              n += 1
+    state.save('images',params,watermark)
+    self.db.commit()
+    return n
+
+  def lookup_filter(self,reload=False):
+    """
+    Returns the LookupFilter of the files of the db, loaded on first use
+
+    The files added by add_files are added to it, reload it if the db
+    was changed by another process
+    """
+    if self._filter is None or reload:
+      self._filter = LookupFilter.load(self.db,self.hash_version)
+    return self._filter
+
+  def find_identical(self,fname):
+    """
+    Returns the list of the paths of the files of the db identical to the
+    given file (that may not be in the db)
+
+    The misses are answered by the lookup filter: after a stat if no file
+    has the same size, after the quick hash (3 blocks) if none has the
+    same qhash. The candidates are then read from the files_size index,
+    and the file is only hashed in full if it is larger than 3 blocks
+    (else the qhash is the hash). The missing hashes of the candidates
+    are computed and saved
+    A file that cannot be read (missing, not readable) is reported and
+    has no identical file
+    """
+    flt = self.lookup_filter()
+    bs,algo = self.cfg.hash_bs,self.cfg.hash_algo
+    try:
+      size = os.path.getsize(fname)
+      if not flt.may_have_size(size):
+        return []
+      qhash = quick_hash_file(fname,bs,algo)
+    except OSError as e:
+      print(f"Could not read {fname}: {e}")
+      return []
+    if not flt.may_have(size,qhash):
+      return []
+    cur = self.db.cursor()
+    cur.execute("""SELECT path,hash FROM files WHERE size = ? AND qhash = ?
+    AND hash_algo = ?""",(size,qhash,self.hash_version))
+    rows = cur.fetchall()
+    if not rows or size < 3*bs:
+      return [p for p,_ in rows]
+    try:
+      h = hash_file(fname,bs,algo)
+    except OSError as e:
+      print(f"Could not read {fname}: {e}")
+      return []
+    r,computed = [],[]
+    for p,ph in rows:
+      if ph is None:
+        try:
+          ph = hash_file(p,bs,algo)
+        except OSError: # Removed since the last scan
+          continue
+        computed.append((ph,p))
+      if ph == h:
+        r.append(p)
+    if computed:
+      cur.executemany("UPDATE files SET hash = ? WHERE path = ?",computed)
+      self.db.commit()
+    return r
+
+  def find_phash(self,h,max_dist=6):
+    """
+    Returns a list of (id,dist) of the images whose perceptual hash
+    has at most max_dist different bits with h
+
+    Uses the indexes on the parts of the hash: a close hash has at least
+    one part within max_dist//phash.PARTS bits of the same part of h,
+    so only the images sharing such a part are read
+    """
+    masks = phash.flips(max_dist//phash.PARTS)
+    queries,args = [],[]
+    for i in range(phash.PARTS):
+      keys = sorted(set(phash.part(h,i) ^ m for m in masks))
+      queries.append(f"""SELECT id,phash FROM img
+      WHERE {phash.part_sql(i)} IN ({','.join('?'*len(keys))})""")
+      args += keys
+    cur = self.db.cursor()
+    cur.execute(' UNION '.join(queries),args)
+    r = [(i,phash.distance(h,p)) for i,p in cur.fetchall()]
+    return sorted((t for t in r if t[1] <= max_dist),key=lambda t:t[1])
+
+  def similar_images(self,fname,max_dist=6):
+    """
+    Returns a list of (path,dist) of the images of the db with a perceptual
+    hash close to the one of the given image (that may not be in the db)
+    """
+    f = self.get_file(fname)
+    if f is None or f.type != IMAGE:
+      f = Image(fname)
+    if f.phash is None:
+      f.compute_signature()
+      if f.phash is None:
+        return []
+    r = dict(self.find_phash(f.phash,max_dist))
+    cur = self.db.cursor()
+    cur.execute(f"SELECT id,path FROM files WHERE id IN "
+        f"({','.join('?'*len(r))})",list(r))
+    return sorted(((p,r[i]) for i,p in cur.fetchall() if p != fname),
+        key=lambda t:t[1])
+
+  def _phash_index(self):
+    """
+    Returns a phash.PHashIndex of all the images with a perceptual hash
+    """
+    c = self.catalog([IMAGE])
+    return phash.PHashIndex(c.id[c.has_phash],c.phash[c.has_phash])
+
+  def compare_phash(self,max_dist=6,full=False):
+    """
+    Finds all the pairs of images with at most max_dist different bits
+    in their perceptual hashes and saves them in the phash_diff table,
+    skipping the pairs in known_diff
+
+    Only the new images are compared, unless full is True
+    (see compare_images)
+    Returns the number of pairs found
+    """
+    state = ComparisonState(self.db)
+    watermark = state.watermark()
+    params = repr((max_dist,))
+    index = self._phash_index()
+    new = None if full else state.new('phash',params,index.ids)
+    ida,idb,dist = index.pairs(max_dist,new)
+    cur = self.db.cursor()
+    cur.execute("SELECT f1,f2 FROM known_diff")
+    known = set(cur.fetchall())
+    if new is None:
+      cur.execute("DELETE FROM phash_diff")
+    n = 0
+    with Writer(self.db) as w:
+      for row in zip(ida.tolist(),idb.tolist(),dist.tolist()):
+        if row[:2] not in known:
+          w.add(PHASH_DIFF_SQL,row)
+          n += 1
+    state.save('phash',params,watermark)
+    self.db.commit()
+    return n
+
+  def phash_clusters(self,max_dist=6):
+    """
+    Returns the groups of images linked by pairs of perceptual hashes with
+    at most max_dist different bits, as lists of paths (largest first)
+    """
+    ida,idb,_ = self._phash_index().pairs(max_dist)
+    groups = phash.clusters(ida,idb)
+    cur = self.db.cursor()
+    cur.execute("SELECT id,path FROM files WHERE type = ?",(IMAGE,))
+    paths = dict(cur.fetchall())
+    return [[paths[i] for i in g] for g in groups]
+
+  def _index_shots(self):
+    """
+    Adds the keys of the videos missing in the shot index
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT id,shots FROM vid WHERE shots IS NOT NULL
+    AND id NOT IN (SELECT id FROM shot_index)""")
+    with Writer(self.db) as w:
+      for vid,shots in cur.fetchall():
+        keys,frames = video_match.shot_keys(np.frombuffer(shots,np.uint32))
+        for row in zip(keys.tolist(),[vid]*len(keys),frames.tolist()):
+          w.add(SHOT_SQL,row)
+
+  def video_candidates(self,fname,top=10,min_votes=2):
+    """
+    Returns the videos that may contain the given one or be contained in it
+    as a list of (path,votes,offset), best first
+
+    The keys of the shots of the video are looked up in the shot index
+    and each match votes for an offset (see video_match.vote):
+    frame t (in seconds) of the video matches t+offset of the candidate
+    """
+    f = self.get_file(fname)
+    if f is None or f.type != VIDEO or f.shots is None:
+      return []
+    self._index_shots()
+    keys,frames = video_match.shot_keys(f.shots)
+    probes,src = video_match.probe_keys(keys)
+    index = {}
+    for p,i in zip(probes.tolist(),src.tolist()):
+      index.setdefault(p,[]).append(i)
+    probes = list(index)
+    cur = self.db.cursor()
+    matches = []
+    for i in range(0,len(probes),500):
+      chunk = probes[i:i+500]
+      cur.execute(f"""SELECT key,id,frame FROM shot_index WHERE key IN
+      ({','.join('?'*len(chunk))}) AND id != ?""",chunk+[f.id])
+      matches += [(k,vid,fr) for key,vid,fr in cur.fetchall()
+          for k in index[key]]
+    m = np.array(matches,dtype=np.int64).reshape(-1,3)
+    r = video_match.vote(frames,m[:,0],m[:,1],m[:,2],top,min_votes)
+    if not r:
+      return []
+    cur.execute(f"SELECT id,path FROM files WHERE id IN "
+        f"({','.join('?'*len(r))})",[t[0] for t in r])
+    paths = dict(cur.fetchall())
+    return [(paths[i],n,o/fps) for i,n,o in r]
+
+  def compare_videos(self,min_score=0.9,min_length=60,max_length_diff=0.05,
+      index=False,top=10,full=False):
+    """
+    Finds the videos contained in other ones, using the normalized
+    cross-correlation of their sigrgb (see video_match.included_pairs)
+
+    If index is True, each video is only compared with its top candidates
+    from the shot index (see video_candidates) instead of all the videos
+
+    The pairs of videos with lengths within max_length_diff (relative)
+    are saved in comparator_identical, the other ones in
+    comparator_included_v1
+    Videos shorter than min_length seconds are skipped, as well as
+    the pairs in known_diff
+    Only the new videos are compared, unless full is True
+    (see compare_images)
+    Returns the number of identical and included pairs
+    """
+    state = ComparisonState(self.db)
+    watermark = state.watermark()
+    params = repr((min_score,min_length,max_length_diff,index,top))
+    cur = self.db.cursor()
+    cur.execute("SELECT id,sigrgb FROM vid WHERE sigrgb IS NOT NULL")
+    rows = cur.fetchall()
+    ids = [r[0] for r in rows]
+    sigs = [np.frombuffer(r[1],dtype=np.uint8).reshape(-1,3) for r in rows]
+    del rows
+    new = None if full else state.new('videos',params,ids)
+    cur.execute("SELECT f1,f2 FROM known_diff")
+    known = set(cur.fetchall())
+    if new is None:
+      cur.execute("DELETE FROM comparator_identical")
+      cur.execute("DELETE FROM comparator_included_v1")
+    min_len = max(int(np.ceil(min_length/video_match.period)),2)
+    if new is not None and not new.any():
+      matches = []
+    elif index:
+      pairs = self._shot_pairs(ids,top)
+      if new is not None:
+        pairs = [(a,b) for a,b in pairs if new[a] or new[b]]
+      matches = video_match.match_pairs(sigs,pairs,min_len,min_score)
+    else:
+      matches = video_match.included_pairs(sigs,min_len,min_score,new=new)
+    n_identical = n_included = 0
+    with Writer(self.db) as w:
+      for ia,ib,score,offset in matches:
+        for a,b,sc,o in zip(ia.tolist(),ib.tolist(),score.tolist(),
+            offset.tolist()):
+          # a starts at o in b
+          o *= video_match.period
+          ida,idb,o = (ids[a],ids[b],-o) if ids[a] < ids[b] else \
+              (ids[b],ids[a],o)
+          if (ida,idb) in known:
+            continue
+          if len(sigs[a]) >= (1-max_length_diff)*len(sigs[b]):
+            w.add(IDENTICAL_SQL,(ida,idb,sc,o))
+            n_identical += 1
+          else:
+            w.add(INCLUDED_SQL,(ida,idb,sc,o))
+            n_included += 1
+    state.save('videos',params,watermark)
+    self.db.commit()
+    return n_identical,n_included
+
+  def comparison_report(self,comparator,threshold=None,limit=None):
+    """
+    Returns the pairs found by a comparator as a list of
+    (path_a,path_b,value), best first
+
+    comparator is one of REPORTS: images (value: diff, see compare_images),
+    phash (dist), identical or included (score, see compare_videos)
+    Only the pairs with a value at most (for a score: at least) threshold
+    are returned. The pairs are read in the order of the covering index
+    of the value
+    """
+    table,col,order = REPORTS[comparator]
+    where,args = "",[]
+    if threshold is not None:
+      where = f"WHERE d.{col} {'<=' if order == 'ASC' else '>='} ?"
+      args.append(threshold)
+    if limit is not None:
+      args.append(limit)
+    cur = self.db.cursor()
+    cur.execute(f"""SELECT fa.path,fb.path,d.{col} FROM {table} d
+    JOIN files fa ON fa.id = d.ida JOIN files fb ON fb.id = d.idb {where}
+    ORDER BY d.{col} {order}{' LIMIT ?' if limit is not None else ''}""",
+    args)
+    return cur.fetchall()
+
+  def refine_video_signatures(self):
+    """
+    Computes in full mode the signatures of the videos fingerprinted in
+    keyframes mode that matched another video in compare_videos
+
+    Run compare_videos again to compare them with the full signatures
+    Returns the number of signatures computed
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT path FROM files WHERE id IN
+    (SELECT id FROM vid WHERE sig_mode = 'keyframes') AND id IN
+    (SELECT ida FROM comparator_identical UNION
+    SELECT idb FROM comparator_identical UNION
+    SELECT ida FROM comparator_included_v1 UNION
+    SELECT idb FROM comparator_included_v1)""")
+    l = [t[0] for t in cur.fetchall()]
+    if l:
+      self.compute_video_signature(l,mode='full')
+    return len(l)
+
+  def _shot_pairs(self,ids,top=10):
+    """
+    Returns the pairs of indices in ids of each video and its top
+    candidates from the shot index
+    """
+    self._index_shots()
+    cur = self.db.cursor()
+    cur.execute("SELECT key,id,frame FROM shot_index")
+    a = np.array(cur.fetchall(),dtype=np.int64).reshape(-1,3)
+    shot_index = video_match.ShotIndex(a[:,0],a[:,1],a[:,2])
+    del a
+    pos = dict((vid,i) for i,vid in enumerate(ids))
+    cur.execute("SELECT id,shots FROM vid WHERE shots IS NOT NULL")
+    pairs = set()
+    for vid,shots in cur.fetchall():
+      if vid not in pos:
+        continue
+      for other,_,_ in shot_index.candidates(vid,
+          np.frombuffer(shots,np.uint32),top):
+        if other in pos:
+          pairs.add(tuple(sorted((pos[vid],pos[other]))))
+    return sorted(pairs)
+
+  def _import_npy(self):
+    """
+    Moves the full signatures saved as npy files by the older versions
+    to the store
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT vid.id,path FROM vid JOIN files USING (id)
+    WHERE sig_pack IS NULL""")
+    for vid,path in cur.fetchall():
+      npy = self._get_npy_path(path)
+      if not os.path.exists(npy):
+        continue
+      location = self.store.append(np.load(npy,mmap_mode='r'))
+      cur.execute("""UPDATE vid SET sig_pack = ?, sig_offset = ?,
+      sig_length = ? WHERE id = ?""",location+(vid,))
+      os.remove(npy)
+      try: # Removes the directories left empty
+        os.removedirs(os.path.dirname(npy))
+      except OSError:
+        pass
+    self.store.close()
+
+  def get_signatures(self,ids=None):
+    """
+    Returns a dict {id: full signature} for the videos of the list
+    (all of them if ids is None)
+
+    The signatures are read-only views of the store, they are only read
+    from the disk when accessed
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT id,sig_pack,sig_offset,sig_length FROM vid
+    WHERE sig_pack IS NOT NULL""")
+    rows = cur.fetchall()
+    if ids is not None:
+      ids = set(ids)
+      rows = [r for r in rows if r[0] in ids]
+    return dict((r[0],self.store.get(*r[1:])) for r in rows)
+
+  def compact_signatures(self):
+    """
+    Rewrites the store of the full video signatures without the ones that
+    are not referenced by the db any more
+
+    Returns the number of bytes freed
+    """
+    self._stop_pool() # The workers hold the packs they write to
+    cur = self.db.cursor()
+    cur.execute("""SELECT id,sig_pack,sig_offset,sig_length FROM vid
+    WHERE sig_pack IS NOT NULL""")
+    old = dict((r[0],tuple(r[1:])) for r in cur.fetchall())
+    size = sum(os.path.getsize(os.path.join(self.cfg.vid_library,p))
+        for p in self.store.packs())
+    new = self.store.compact(old)
+    cur.executemany("""UPDATE vid SET sig_pack = ?, sig_offset = ?,
+    sig_length = ? WHERE id = ?""",[l+(i,) for i,l in new.items()])
+    self.db.commit()
+    self.store.remove_packs()
+    return size-sum(os.path.getsize(os.path.join(self.cfg.vid_library,p))
+        for p in self.store.packs())
 
   def check_integrity(self): # TODO
     """
@@ -409,14 +1661,125 @@ class Database:
     """
     pass
 
-  def filter_matching(self,key,source=None):
+  def rehash_outdated(self):
+    """
+    Recomputes qhash (and clears hash) for the files hashed with another
+    algorithm or block size than the ones of the config
+
+    Only these files are read, the other data (signatures...) is kept.
+    The files that cannot be read are reported and left as they are
+    (see detect_and_add)
+    """
+    cur = self.db.cursor()
+    cur.execute("""SELECT path,size,mtime,inode,dev FROM files
+        WHERE hash_algo IS NOT ?""",(self.hash_version,))
+    # The stored stat is kept: changes are handled by detect_and_add
+    l = [self.new_file(t[0],**dict(zip(['size','mtime','inode','dev'],t[1:])))
+        for t in cur.fetchall()]
+    if not l:
+      return
+    print(f"Rehashing {len(l)} files with {self.hash_version}")
+    toadd,failed = [],[]
+    for i,(v,error) in enumerate(self._imap_io(rehash,l),1):
+      print(f"\r{i}/{len(l)} ({100*i/len(l):.2f}%)",end='')
+      if error is None:
+        toadd.append(v[1:]+v[:1])
+      else:
+        failed.append((v[0],error))
+    print()
+    for p,error in failed:
+      print(f"Could not read {p}: {error}")
+    cur.executemany("""UPDATE files SET qhash = ?, size = ?, type = ?,
+    hash = ?, mtime = ?, inode = ?, dev = ?, hash_algo = ? WHERE path = ?""",
+    toadd)
+    self.db.commit()
+
+  def _group_by(self,sql,args=()):
+    """
+    Runs a query returning (key1,...,path) rows ordered by key
+
+    Yields the tuples of paths sharing the same key (only if there are 2+)
+    """
+    cur = self.db.cursor()
+    cur.execute(sql,args)
+    for _,g in groupby(cur,key=lambda row:row[:-1]):
+      t = tuple(row[-1] for row in g)
+      if len(t) > 1:
+        yield t
+
+  def _get_keys(self,key,paths,compute=True):
+    """
+    Returns a dict {path: value of the key} for the given paths
+
+    If key is 'hash' and compute is True, the missing hashes are computed
+    and saved in the db (the files that cannot be read are reported and
+    left out)
+    """
+    col = {'size':'size','qhash':'size,qhash','hash':'hash'}[key]
+    cur = self.db.cursor()
+    d = {}
+    for i in range(0,len(paths),500): # SQLite limits the number of args
+      chunk = paths[i:i+500]
+      cur.execute(f"""SELECT path,{col} FROM files WHERE path IN
+          ({','.join(['?' for f in chunk])})""",chunk)
+      d.update((r[0],r[1:]) for r in cur.fetchall())
+    if key == 'hash' and compute:
+      computed = []
+      for p in order([p for p in paths if p in d and d[p][0] is None]):
+        try:
+          d[p] = (hash_file(p,self.cfg.hash_bs,self.cfg.hash_algo),)
+        except OSError as e: # Removed since the last scan
+          print(f"Could not read {p}: {e}")
+          del d[p]
+          continue
+        computed.append((d[p][0],p))
+      if computed:
+        cur.executemany("UPDATE files SET hash = ? WHERE path = ?",computed)
+        self.db.commit()
+    return d
+
+  def _compare(self,t):
+    """
+    Splits a tuple of paths in groups of identical files
+
+    The stored hashes are used if all the files have one, else the files
+    are compared with compare_files and the hashes of the identical files
+    are saved in the db
+    """
+    d = self._get_keys('hash',list(t),compute=False)
+    if all(v[0] is not None for v in d.values()):
+      return self._split('hash',[t])
+    r = compare_files([p for p in t if p in d],
+        self.cfg.hash_bs,self.cfg.hash_algo)
+    cur = self.db.cursor()
+    cur.executemany("UPDATE files SET hash = ? WHERE path = ?",
+        [(h,p) for h,g in r for p in g])
+    self.db.commit()
+    return [tuple(g) for _,g in r]
+
+  def _split(self,key,source,compare=False):
+    """
+    Splits each tuple of the source in groups of files with the same key
+    """
+    for t in source:
+      if key == 'hash' and compare:
+        yield from self._compare(t)
+        continue
+      d = self._get_keys(key,list(t))
+      t = sorted((p for p in t if p in d),key=lambda p:d[p])
+      for _,g in groupby(t,key=lambda p:d[p]):
+        g = tuple(g)
+        if len(g) > 1:
+          yield g
+
+  def filter_matching(self,key,source=None,compare=True):
     """
     Takes a list of tuple files
     Assuming each tuple in the list contains files that must be compared
     together. If source=None, all the files from the db are compared
 
-    Returns a list of tuples only containing matching files based on the key
-    tuples of 1 are removed
+    Returns a generator of tuples only containing matching files based on
+    the key, tuples of 1 are removed
 
     Examples : key='size', source = [(f1,f2),(f3,f4)],
     all files are the same size except f4
@@ -428,8 +1791,28 @@ class Database:
     key = qhash, source = [(fa1,fa2,fb1,fb2,fc)] where the files
     with the same letter have the same qhash
     out = [(fa1,fa2),(fb1,fb2)]
+
+    The files are identified by their path. When source is None, the
+    cheapest keys are used first: files with a unique size are never read
+    and the full hash is only computed for the qhash collisions
+    (the result is saved in the db)
+
+    For key = 'hash', if compare is True, the files without a hash are
+    compared together instead of being hashed one by one: reading stops
+    as soon as they differ and only the identical files get their hash
     """
     assert key in ['size','qhash','hash']
-    cur = self.db.cursor()
-    if source is None:
-      cur.execute("SELECT") # TODO
+    if key != 'size': # Hashes made with different algorithms differ
+      self.rehash_outdated()
+    if source is not None:
+      return self._split(key,source,compare)
+    if key == 'size':
+      return self._group_by("""SELECT size,path FROM files WHERE size IN
+      (SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1)
+      ORDER BY size""")
+    elif key == 'qhash':
+      return self._group_by("""SELECT f.size,f.qhash,f.path
+      FROM files f JOIN (SELECT size,qhash FROM files GROUP BY size,qhash
+      HAVING COUNT(*) > 1) g ON f.size = g.size AND f.qhash = g.qhash
+      ORDER BY f.size,f.qhash""")
+    return self._split('hash',self.filter_matching('qhash'),compare)
@@ -1,5 +1,5 @@
 import os
-from .hashing import quick_hash_file, hash_file
+from .hashing import quick_hash_file, hash_file, hash_version, parse_version
 
 NOMEDIA = 0
 IMAGE = 1
@@ -18,14 +18,24 @@ def human_readable(size):
   return f"{size/1024**i:.2f} {prefix}iB"
 
 
+def stat_key(st):
+  """
+  Takes an os.stat_result (or DirEntry.stat()), returns the tuple
+  (size,mtime,inode,dev) used to detect if a file changed
+  """
+  return (st.st_size,st.st_mtime_ns,st.st_ino,st.st_dev)
+
+
 class File:
   """
   Object representing a file in the context of the Database
   """
   def __init__(self,path,**kwargs):
     self.path = path
-    for kw in ['_qhash','_size','hash']:
+    for kw in ['id','_qhash','_size','hash','mtime','inode','dev']:
       setattr(self,kw,kwargs.pop(kw.strip('_'),None))
+    # Algorithm and block size of qhash and hash (see hash_version)
+    self.hash_algo = kwargs.pop('hash_algo',None) or hash_version()
     # Do not forget to raise an Exception if we have invalid kwargs
     # If we make a media, the media constructor will handle it
     if kwargs:
@@ -35,20 +45,29 @@ class File:
   @property
   def qhash(self):
     if self._qhash is None:
-      self._qhash = quick_hash_file(self.path)
-      if self.size < 3*1024*1024:
+      algo,bs = parse_version(self.hash_algo)
+      self._qhash = quick_hash_file(self.path,bs,algo)
+      if self.size < 3*bs:
         self.hash = self._qhash
     return self._qhash
 
   @property
   def size(self):
     if self._size is None:
-      self._size = os.path.getsize(self.path)
+      self.compute_stat()
     return self._size
 
+  def compute_stat(self):
+    """
+    Reads the size, mtime (in ns), inode and device of the file
+    """
+    st = os.stat(self.path)
+    self._size,self.mtime,self.inode,self.dev = stat_key(st)
+
   def compute_hash(self,recompute=False):
     if recompute or self.hash is None:
-      self.hash = hash_file(self.path)
+      algo,bs = parse_version(self.hash_algo)
+      self.hash = hash_file(self.path,bs,algo)
 
   def __repr__(self):
     t = {NOMEDIA:'NOMEDIA',IMAGE:'IMAGE',VIDEO:'VIDEO'}[self.type]
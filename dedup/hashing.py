@@ -1,37 +1,206 @@
+import errno
 import hashlib
 import os
+import threading
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
 
 M = 1048576 # 1024**2
+# Max number of files read together by compare_files
+MAX_OPEN = 64
+# Errors of a file removed or made unreadable since the last scan
+# (the other ones, like too many open files, are raised)
+GONE_ERRNO = (errno.ENOENT,errno.EACCES,errno.EIO)
 
+# Available hash algorithms: name -> constructor of a hashlib-like object
+HASHES = {
+  'md5':hashlib.md5,
+  'sha1':hashlib.sha1,
+  'sha256':hashlib.sha256,
+  'blake2b':lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+  HASHES['xxh64'] = xxhash.xxh64
+  HASHES['xxh128'] = xxhash.xxh3_128
 
-def quick_hash_file(fname,bs=M):
+_local = threading.local()
+
+
+def get_hash(algo):
+  """
+  Returns a new hash object of the given algorithm (see HASHES)
+  """
+  try:
+    return HASHES[algo]()
+  except KeyError:
+    raise ValueError(f"Unknown hash algorithm: {algo} "
+        f"(available: {', '.join(HASHES)})") from None
+
+
+def hash_version(algo='md5',bs=M):
+  """
+  Returns the string identifying the values of qhash and hash,
+  stored in the db along with them
+  """
+  return f"{algo}:{bs}"
+
+
+def parse_version(version):
+  """
+  Returns (algo,bs) from a string made by hash_version
+  """
+  algo,bs = version.split(':')
+  return algo,int(bs)
+
+
+def get_buffer(bs):
+  """
+  Returns a memoryview of a bytearray of size bs
+
+  The same buffer is returned for each call in a thread, to avoid
+  allocating a new bytes object for each chunk
+  """
+  buf = getattr(_local,'buf',None)
+  if buf is None or len(buf) != bs:
+    buf = _local.buf = memoryview(bytearray(bs))
+  return buf
+
+
+def _update(h,f,buf):
+  """
+  Reads the file into buf until it is full or the end of the file is
+  reached and updates the hash object with it
+
+  Returns the number of bytes read
+  """
+  n = 0
+  while n < len(buf):
+    k = f.readinto(buf[n:])
+    if not k:
+      break
+    n += k
+  h.update(buf[:n])
+  return n
+
+
+def _advise(f,offset,length,advice):
+  """
+  Gives a hint about the next reads of the file to the kernel
+  (posix_fadvise, ignored where it is not available)
+  """
+  if hasattr(os,'posix_fadvise'):
+    try:
+      os.posix_fadvise(f.fileno(),offset,length,getattr(os,advice))
+    except OSError:
+      pass
+
+
+def quick_hash_file(fname,bs=M,algo='md5'):
   """
   Returns a quicker hash of the file at the given location
   Collisions can happen easily, always perform a full hash in case of collision
 
-  Warning! Changing the bs will change the value of the hash
+  Warning! Changing the bs or algo will change the value of the hash
   """
   size = os.path.getsize(fname)
   if size < 3*bs:
-    return hash_file(fname,bs)
-  h = hashlib.md5()
-  with open(fname,'rb') as f:
-    h.update(f.read(bs))
+    return hash_file(fname,bs,algo)
+  h = get_hash(algo)
+  buf = get_buffer(bs)
+  with open(fname,'rb',buffering=0) as f:
+    # The three blocks are requested at once, the disk can read them
+    # in its own order
+    for offset in (0,size//2,size-bs):
+      _advise(f,offset,bs,'POSIX_FADV_WILLNEED')
+    _update(h,f,buf)
     f.seek(size//2,0)
-    h.update(f.read(bs))
+    _update(h,f,buf)
     f.seek(-bs,2)
-    h.update(f.read(bs))
+    _update(h,f,buf)
   return h.digest()
 
 
-def hash_file(fname,bs=M):
+def hash_file(fname,bs=M,algo='md5'):
   """
   Returns the hash of the file at the given location
   """
-  h = hashlib.md5()
-  with open(fname,'rb') as f:
-    chunk = f.read(bs)
-    while chunk:
-      h.update(chunk)
-      chunk = f.read(bs)
+  h = get_hash(algo)
+  buf = get_buffer(bs)
+  with open(fname,'rb',buffering=0) as f:
+    _advise(f,0,0,'POSIX_FADV_SEQUENTIAL') # Larger read-ahead
+    while _update(h,f,buf) == bs:
+      pass
     return h.digest()
+
+
+def _gone(fname,e):
+  """
+  Reports a file that cannot be read any more (see GONE_ERRNO),
+  raises the other errors
+  """
+  if e.errno not in GONE_ERRNO:
+    raise e
+  print(f"Could not read {fname}: {e}")
+
+
+def compare_files(fnames,bs=M,algo='md5'):
+  """
+  Compares the content of the files by reading them all together,
+  chunk by chunk: the groups are split as soon as their contents differ
+  and a file that matches no other is not read any further
+
+  Returns a list of (hash,[fnames]) for each group of identical files
+  (groups of 1 are removed), hash is the same as with hash_file
+  A file that cannot be read any more is reported and left out of the
+  groups. Above MAX_OPEN files, they are hashed one by one instead (the
+  memory usage is one chunk per file read together)
+  """
+  if len(fnames) > MAX_OPEN:
+    groups = {}
+    for fname in fnames:
+      try:
+        groups.setdefault(hash_file(fname,bs,algo),[]).append(fname)
+      except OSError as e:
+        _gone(fname,e)
+    return [(h,g) for h,g in groups.items() if len(g) > 1]
+  files = {}
+  try:
+    for fname in fnames:
+      try:
+        files[fname] = open(fname,'rb')
+      except OSError as e:
+        _gone(fname,e)
+    # Identical files have the same chunks: only one hash per group
+    groups = [(get_hash(algo),list(files))]
+    r = []
+    while groups:
+      new = []
+      for h,members in groups:
+        chunks = {}
+        for fname in members:
+          try:
+            chunk = files[fname].read(bs)
+          except OSError as e:
+            files.pop(fname).close()
+            _gone(fname,e)
+            continue
+          chunks.setdefault(chunk,[]).append(fname)
+        for chunk,sub in chunks.items():
+          if len(sub) < 2:
+            files.pop(sub[0]).close()
+            continue
+          sh = h.copy() if len(chunks) > 1 else h
+          if not chunk: # End of the files
+            r.append((sh.digest(),sub))
+            for fname in sub:
+              files.pop(fname).close()
+          else:
+            sh.update(chunk)
+            new.append((sh,sub))
+      groups = new
+    return r
+  finally:
+    for f in files.values():
+      f.close()
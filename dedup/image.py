@@ -1,52 +1,127 @@
 import cv2
 import numpy as np
-from PIL import Image as PILImage
 
 from .file import File,IMAGE
+from .probe import probe_image
+from .phash import dhash
 
+# Formats that can be decoded at a reduced scale directly by the codec
+REDUCED_FORMATS = ['JPEG']
+REDUCED_FLAGS = {2:cv2.IMREAD_REDUCED_COLOR_2,
+    4:cv2.IMREAD_REDUCED_COLOR_4,
+    8:cv2.IMREAD_REDUCED_COLOR_8}
+# The smallest side of a reduced image must remain above this size
+min_decode_size = 256
 
-def make_signature(img):
-  h,w,_ = img.shape
-  Y,X = 3,3 # The size of the evaluation grid
-  sig = np.empty((Y,X,3),dtype=np.uint16)
-  for c in range(3):
-    for i in range(Y):
-      for j in range(X):
-        sig[i,j,c] = np.average(img[
-            int(h*i/Y):int(h*(i+1)/Y),
-            int(w*j/X):int(w*(j+1)/X),c])*256
-  return sig
+
+def grid_sums(a,grid=3):
+  """
+  Takes a (...,h,w,c) array of images, returns the sum of each cell of
+  a grid*grid evaluation grid as a (...,grid,grid,c) array
+  and the number of pixels of each cell as a (grid,grid) array
+
+  Only one pass is made over the pixels
+  """
+  h,w = a.shape[-3:-1]
+  ys = [int(h*i/grid) for i in range(grid)]
+  xs = [int(w*j/grid) for j in range(grid)]
+  # Sum of each column of each row of cells, without casting the whole image
+  s = np.stack([a[...,y0:y1,:,:].sum(axis=-3,dtype=np.uint32)
+    for y0,y1 in zip(ys,ys[1:]+[h])],axis=-3)
+  s = np.add.reduceat(s,xs,axis=-2,dtype=np.uint64)
+  # Cells can only be empty for images smaller than the grid
+  cnt = np.maximum(np.outer(np.diff(ys+[h]),np.diff(xs+[w])),1)
+  return s,cnt
+
+
+def make_signatures(imgs,grid=3):
+  """
+  Takes a list of decoded images, returns their signatures as a
+  (n,grid,grid,3) array and their average colors as a (n,3) array
+
+  The average colors are deduced from the sums of the cells
+  and the small images of the same shape are processed together
+  """
+  sigs = np.empty((len(imgs),grid,grid,3),dtype=np.uint16)
+  brightness = np.empty((len(imgs),3))
+  shapes = {}
+  for i,img in enumerate(imgs):
+    shapes.setdefault(img.shape,[]).append(i)
+  for (h,w,_),idx in shapes.items():
+    # Stacking large images would cost more than the loop it saves
+    batches = [idx] if h*w <= 1<<20 else [[i] for i in idx]
+    for b in batches:
+      a = imgs[b[0]][None] if len(b) == 1 else np.stack([imgs[i] for i in b])
+      s,cnt = grid_sums(a,grid)
+      sigs[b] = s*256//cnt[:,:,None]
+      brightness[b] = s.sum(axis=(1,2))/(h*w)
+  return sigs,brightness
+
+
+def decode(path,info=None):
+  """
+  Decodes the image for the computation of its signature
+
+  JPEG images are decoded at 1/2, 1/4 or 1/8 scale (in the DCT domain)
+  as long as their smallest side remains above min_decode_size pixels,
+  the other ones are fully decoded
+  info is the dict returned by probe_image (read if not given)
+  """
+  if info is None:
+    info = probe_image(path)
+  flag = cv2.IMREAD_COLOR
+  if info['format'] in REDUCED_FORMATS:
+    side = min(info['width'],info['height'])
+    for f in (8,4,2):
+      if side//f >= min_decode_size:
+        flag = REDUCED_FLAGS[f]
+        break
+  return cv2.imread(path,flag)
+
+
+def make_signature(img,grid=3):
+  """
+  Returns the signature of a decoded image: the average color of each cell
+  of a grid*grid evaluation grid, times 256
+  """
+  return make_signatures([img],grid)[0][0]
 
 
 class Image(File):
   def __init__(self,path,**kwargs):
     self.path = path
-    for kw in ['_height','_width','brightness','signature']:
+    for kw in ['_height','_width','brightness','signature','grid','phash']:
       setattr(self,kw,kwargs.pop(kw.strip('_'),None))
     if self.brightness is None:
       self.brightness = (0,0,0)
+    if self.grid is None: # Size of the evaluation grid of the signature
+      self.grid = 3
     File.__init__(self,path,**kwargs)
     self.type = IMAGE
 
   def compute_attr(self):
     try:
-      img = PILImage.open(self.path)
-      self._width,self._height = img.size
+      info = probe_image(self.path)
+      self._width,self._height = info['width'],info['height']
     except Exception as e:
       print(f"[Image] Error processing {self.path}: {type(e).__name__}: {e}")
       self._height, self._width = 0,0
 
   def compute_signature(self):
     try:
-      img = cv2.imread(self.path,cv2.IMREAD_COLOR)
-      self._height,self._width,_ = img.shape
-      self.brightness = tuple(np.average(img,axis=(0,1)))
-      self.signature = make_signature(img)
+      info = probe_image(self.path)
+      self._width,self._height = info['width'],info['height']
+      img = decode(self.path,info)
+      sigs,brightness = make_signatures([img],self.grid)
+      self.brightness = tuple(brightness[0])
+      self.signature = sigs[0]
+      self.phash = dhash(img)
     except Exception as e:
       print(f"[Image] Error processing {self.path}: {type(e).__name__}: {e}")
       self._height, self._width = 0,0
       self.brightness = (0,0,0)
-      self.signature = np.zeros((3,3,3),dtype=np.unit16)
+      self.signature = np.zeros((self.grid,self.grid,3),dtype=np.uint16)
+      self.phash = None
 
   @property
   def height(self):
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def similar_pairs(ids,sizes,brightness,sigs,max_diff=8,max_ratio_diff=0.05,
+    block=1024,new=None):
+  """
+  Finds the pairs of similar images
+
+  ids: (n,) ids of the images
+  sizes: (n,2) width and height of the images
+  brightness: (n,3) average colors of the images (0-255)
+  sigs: (n,k) signatures of the images (0-255, see image.make_signature)
+
+  Yields (ida,idb,diff) arrays for each block, with ida < idb and diff the
+  average absolute difference between the signatures (0-255)
+  Only the pairs with diff <= max_diff and an aspect ratio differing by
+  less than max_ratio_diff (relative) are kept
+  If new is given (a (n,) bool array), only the pairs with at least one
+  new image are compared: the other ones are known already
+
+  The images are sorted by brightness, so only a window of the matrix has
+  to be computed. It is done by blocks of block*block pairs, where pairs
+  with a different aspect ratio are pruned, then the pairs too far apart
+  in euclidean distance (computed with a matrix product) since the L1
+  distance can not be lower. The differences of the signatures are only
+  computed for the remaining pairs
+  """
+  n = len(ids)
+  m = brightness.mean(axis=1)
+  order = np.argsort(m,kind='stable')
+  ids,m,sigs = ids[order],m[order],np.ascontiguousarray(sigs[order])
+  k = sigs.shape[1]
+  sq = (sigs.astype(np.float64)**2).sum(axis=1)
+  ones = np.ones(k,dtype=sigs.dtype)
+  max_d2 = (k*max_diff)**2
+  ratio = np.log(sizes[order,0]/sizes[order,1])
+  max_ratio = np.log1p(max_ratio_diff)
+  # If the signatures are close, so are the average colors:
+  # |m_a-m_b| <= sum(|brightness_a-brightness_b|)/3 <= max_diff
+  # (cells have almost the same size)
+  hi = np.searchsorted(m,m+max_diff,side='right')
+  if new is None: # Each image with the next ones in the window
+    rows = lo = np.arange(n)
+    new = np.ones(n,dtype=bool)
+  else: # Each new image with all the images of its window
+    new = new[order]
+    rows = np.nonzero(new)[0]
+    lo = np.searchsorted(m,m-max_diff,side='left')
+  # The rows are taken by blocks of at most block rows within max_diff
+  # of brightness, so that their windows of columns are narrow
+  ends = np.searchsorted(m[rows],m[rows]+max_diff,side='right')
+  r0 = 0
+  while r0 < len(rows):
+    r = rows[r0:min(r0+block,ends[r0])]
+    r0 += len(r)
+    for c0 in range(lo[r[0]],hi[r[-1]],block):
+      c1 = min(c0+block,hi[r[-1]])
+      c = np.arange(c0,c1)
+      # Two new images are compared once
+      mask = (r[:,None] < c[None,:]) | \
+          ((r[:,None] != c[None,:]) & ~new[None,c0:c1])
+      mask &= np.abs(ratio[r,None]-ratio[None,c0:c1]) <= max_ratio
+      # ||a-b||_2 <= ||a-b||_1 <= k*max_diff (with a margin for rounding)
+      d2 = sq[r,None]+sq[None,c0:c1]-2*(sigs[r]@sigs[c0:c1].T)
+      mask &= d2 <= max_d2+1e-4*(sq[r,None]+sq[None,c0:c1])
+      ii,jj = np.nonzero(mask)
+      ii = r[ii]
+      jj += c0
+      for p in range(0,len(ii),1<<16): # Bounds the memory usage
+        a,b = ii[p:p+(1<<16)],jj[p:p+(1<<16)]
+        d = np.take(sigs,a,axis=0)
+        d -= np.take(sigs,b,axis=0)
+        diff = (np.abs(d,out=d)@ones)/k # Faster than .mean(axis=1)
+        keep = diff <= max_diff
+        ida,idb = ids[a[keep]],ids[b[keep]]
+        yield np.minimum(ida,idb),np.maximum(ida,idb),diff[keep]
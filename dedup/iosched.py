@@ -0,0 +1,171 @@
+import os
+import struct
+import threading
+from collections import deque
+try:
+  import fcntl
+except ImportError: # Windows: the files are ordered by inode
+  fcntl = None
+
+FS_IOC_FIEMAP = 0xC020660B # Linux ioctl giving the extents of a file
+# struct fiemap followed by one struct fiemap_extent
+FIEMAP = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+_rotational = {}
+
+
+def is_rotational(dev):
+  """
+  Returns True if the device (st_dev) is a spinning disk, False if it is
+  an SSD, None if it cannot be told (not Linux, network or virtual fs...)
+
+  Read from /sys/dev/block, the queue of a partition is its disk's one
+  """
+  if dev not in _rotational:
+    r = None
+    base = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    for path in (base+"/queue/rotational",base+"/../queue/rotational"):
+      try:
+        with open(path) as f:
+          r = f.read().strip() == '1'
+        break
+      except OSError:
+        pass
+    _rotational[dev] = r
+  return _rotational[dev]
+
+
+def physical_offset(path):
+  """
+  Returns the physical offset on the disk of the start of the file,
+  or None if the filesystem does not tell it (FIEMAP on Linux)
+  """
+  if fcntl is None:
+    return None
+  buf = bytearray(FIEMAP.pack(0,2**64-1,0,0,1,0)+bytes(FIEMAP_EXTENT.size))
+  try:
+    fd = os.open(path,os.O_RDONLY)
+    try:
+      fcntl.ioctl(fd,FS_IOC_FIEMAP,buf)
+    finally:
+      os.close(fd)
+  except OSError:
+    return None
+  if not FIEMAP.unpack_from(buf)[3]: # No extent (empty file, inline data)
+    return None
+  return FIEMAP_EXTENT.unpack_from(buf,FIEMAP.size)[1]
+
+
+class IOScheduler:
+  """
+  Orders and throttles the reads of files by device, for the hashing
+
+  The items (files) are taken from the source by windows of window
+  items, grouped by device and sorted by physical location on the
+  spinning disks (by inode if unknown, which is close to the location on
+  most filesystems). At most hdd items of a spinning disk are read at
+  once (and ssd items of the other devices), the devices being served
+  in turn. Each item given by items() must be given back to done()
+  once read
+
+  key returns (path,dev,inode) of an item
+  """
+  def __init__(self,source,key,hdd=1,ssd=8,window=1000):
+    self.source = iter(source)
+    self.key = key
+    self.limits = {True:hdd,False:ssd,None:ssd}
+    self.window = window
+    self.pending = {} # dev -> deque of items, in the order of the reads
+    self.running = {} # dev -> number of items being read
+    self.count = 0 # Number of pending items
+    self.exhausted = False
+    self.cond = threading.Condition()
+
+  def _refill(self):
+    """
+    Reads the next window of items and adds them to the pending ones
+    """
+    new = {}
+    for item in self.source:
+      path,dev,ino = self.key(item)
+      new.setdefault(dev,[]).append((ino,path,item))
+      if sum(len(l) for l in new.values()) >= self.window:
+        break
+    else:
+      self.exhausted = True
+    for dev,l in new.items():
+      if is_rotational(dev):
+        l = [(physical_offset(path),ino,path,item) for ino,path,item in l]
+        # The files with a known location first, then by inode
+        l.sort(key=lambda t:(t[0] is None,t[0] or 0,t[1]))
+      else:
+        l.sort(key=lambda t:t[:2])
+      with self.cond:
+        self.pending.setdefault(dev,deque()).extend(t[-1] for t in l)
+        self.count += len(l)
+
+  def _next(self):
+    """
+    Returns the next (dev,item) that can be read, None if there are no
+    more items and False if all the devices are busy
+    """
+    for dev in list(self.pending):
+      q = self.pending[dev]
+      if q and self.running.get(dev,0) < self.limits[is_rotational(dev)]:
+        self.running[dev] = self.running.get(dev,0)+1
+        self.count -= 1
+        # The next device is served first the next time
+        self.pending[dev] = self.pending.pop(dev)
+        return dev,q.popleft()
+    return None if self.exhausted and not self.count else False
+
+  def items(self):
+    """
+    Generator yielding the (dev,item) to read, waiting for a slot
+    of their device
+    """
+    while True:
+      if not self.exhausted and self.count < self.window//2:
+        self._refill()
+      with self.cond:
+        r = self._next()
+        while r is False and (self.exhausted or self.count):
+          self.cond.wait()
+          r = self._next()
+      if r:
+        yield r
+      elif r is None:
+        return
+
+  def done(self,dev):
+    """
+    Frees the slot of an item of the device
+    """
+    with self.cond:
+      self.running[dev] -= 1
+      self.cond.notify()
+
+  def stop(self):
+    """
+    Drops the pending items (to stop early)
+    """
+    with self.cond:
+      self.pending = {}
+      self.count = 0
+      self.exhausted = True
+      self.cond.notify_all()
+
+
+def order(paths):
+  """
+  Returns the paths sorted in the order of the reads (see IOScheduler)
+  """
+  def key(p):
+    try:
+      st = os.stat(p)
+    except OSError:
+      return (0,0,0,p)
+    off = physical_offset(p) if is_rotational(st.st_dev) else None
+    return (st.st_dev,off is None,off or 0,st.st_ino)
+  return sorted(paths,key=key)
@@ -0,0 +1,131 @@
+import os
+import socket
+import threading
+from time import time
+import sqlite3
+
+
+def worker_name():
+  """
+  Name of this worker in the job queue: host and pid
+  """
+  return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+  """
+  Queue of the signatures to compute, kept in the jobs table of the db
+  so that it can be shared by several workers, on several machines
+
+  A worker claims a batch of jobs by taking a lease on them: they are
+  not given to the other workers until the lease expires. The lease is
+  renewed while the worker is running (see Heartbeat), so the jobs of a
+  crashed worker are given again after lease seconds. A job claimed
+  max_tries times is not given any more
+  """
+  def __init__(self,db,lease=300,max_tries=3):
+    self.db = db
+    self.lease = lease
+    self.max_tries = max_tries
+
+  def add(self,jobs,t):
+    """
+    Adds the files of type t to the queue, given as (id,cost) tuples
+    (the ones already queued are kept as is)
+    """
+    with self.db:
+      self.db.executemany("""INSERT OR IGNORE INTO jobs (id,type,cost)
+      VALUES (?,?,?)""",[(i,t,c) for i,c in jobs])
+
+  def claim(self,worker,n):
+    """
+    Takes a lease on up to n available jobs and returns them as a list
+    of (id,type), the most expensive first (for each type): the long
+    jobs are started early and the short ones fill the gaps at the end
+    """
+    now = time()
+    # Taken at once, so two workers never claim the same jobs
+    self.db.execute("BEGIN IMMEDIATE")
+    try:
+      cur = self.db.execute("""SELECT id,type FROM jobs
+      WHERE (worker IS NULL OR expires < ?) AND tries < ?
+      ORDER BY type,cost DESC,id LIMIT ?""",(now,self.max_tries,n))
+      jobs = cur.fetchall()
+      self.db.executemany("""UPDATE jobs SET worker = ?, expires = ?,
+      tries = tries+1 WHERE id = ?""",
+      [(worker,now+self.lease,i) for i,_ in jobs])
+      self.db.commit()
+    except BaseException:
+      self.db.rollback()
+      raise
+    return jobs
+
+  def renew(self,worker):
+    """
+    Extends the leases of the jobs of the worker
+    """
+    with self.db:
+      self.db.execute("UPDATE jobs SET expires = ? WHERE worker = ?",
+          (time()+self.lease,worker))
+
+  def done(self,ids):
+    """
+    Removes the jobs of the given ids (their results are saved)
+    """
+    ids = list(ids)
+    with self.db:
+      for i in range(0,len(ids),500): # SQLite limits the number of args
+        chunk = ids[i:i+500]
+        self.db.execute(f"""DELETE FROM jobs WHERE id IN
+        ({','.join(['?' for _ in chunk])})""",chunk)
+
+  def release(self,worker):
+    """
+    Gives back the jobs of the worker that are not done
+    (the try is counted: a job making the workers fail is dropped
+    after max_tries)
+    """
+    with self.db:
+      self.db.execute("""UPDATE jobs SET worker = NULL, expires = NULL
+      WHERE worker = ?""",(worker,))
+
+  def status(self):
+    """
+    Returns a dict with the number of pending, running (leased)
+    and failed (tried max_tries times) jobs
+    """
+    cur = self.db.execute("""SELECT
+    SUM(tries < ? AND (worker IS NULL OR expires < ?)),
+    SUM(worker IS NOT NULL AND expires >= ?),
+    SUM(tries >= ? AND (worker IS NULL OR expires < ?)) FROM jobs""",
+    (self.max_tries,)+(time(),)*2+(self.max_tries,time()))
+    return dict(zip(['pending','running','failed'],
+        [n or 0 for n in cur.fetchone()]))
+
+
+class Heartbeat(threading.Thread):
+  """
+  Renews the leases of a worker every lease/3 seconds until stopped
+
+  It uses its own connection to the db (a connection can only be used
+  by the thread that created it)
+  """
+  def __init__(self,db_file,worker,lease=300):
+    threading.Thread.__init__(self,daemon=True)
+    self.db_file = db_file
+    self.worker = worker
+    self.lease = lease
+    self.stopped = threading.Event()
+
+  def run(self):
+    db = sqlite3.connect(self.db_file,timeout=self.lease/3)
+    try:
+      q = JobQueue(db,self.lease)
+      while not self.stopped.wait(self.lease/3):
+        q.renew(self.worker)
+    finally:
+      db.close()
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
@@ -0,0 +1,47 @@
+import sys
+import argparse
+
+from .database import Database
+from .file import IMAGE
+
+
+def main(argv=None):
+  """
+  Entry point of the lookup: python -m dedup.lookup config.cfg file...
+
+  Prints the files of the db identical to each file (and similar to the
+  images with --similar). Exits with 1 if a file is already in the db,
+  so that an ingest script can store the file only if it is new
+  """
+  parser = argparse.ArgumentParser(prog='python -m dedup.lookup',
+      description="Tells if files are already in the db")
+  parser.add_argument('config',help="config file")
+  parser.add_argument('files',nargs='+',
+      help="files to look up (- to read the paths from stdin)")
+  parser.add_argument('--similar',action='store_true',
+      help="also look up the similar images (perceptual hash)")
+  parser.add_argument('--max-dist',type=int,default=6,
+      help="max number of different bits of the perceptual hashes")
+  args = parser.parse_args(argv)
+  files = args.files
+  if files == ['-']:
+    files = [l.rstrip('\n') for l in sys.stdin if l.strip()]
+  found = False
+  with Database(args.config,1) as db:
+    for fname in files:
+      identical = db.find_identical(fname)
+      similar = db.similar_images(fname,args.max_dist) if args.similar \
+          and db.get_type(fname) == IMAGE else []
+      similar = [(p,d) for p,d in similar if p not in identical]
+      found |= bool(identical or similar)
+      if not identical and not similar:
+        print(f"{fname}: new")
+      for p in identical:
+        print(f"{fname}: identical to {p}")
+      for p,d in similar:
+        print(f"{fname}: similar to {p} ({d} bits)")
+  return 1 if found else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def qhash_key(qhash):
+  """
+  Returns the int64 key of a qhash kept by a LookupFilter (its first
+  8 bytes)
+  """
+  return int(np.frombuffer(qhash[:8],dtype=np.int64)[0])
+
+
+class LookupFilter:
+  """
+  Compact in-memory copy of the sizes and quick hashes of the files of a
+  db, as sorted arrays (8 bytes per file for each), telling without
+  querying the db that a file is not in it
+
+  A file whose size or qhash key is not in the filter is not in the db.
+  The other ones may be (the keys are truncated and the files removed
+  since are not dropped): the db has to be checked
+  Files added since the filter was loaded are given to add
+  """
+  def __init__(self,sizes,qhashes):
+    self.sizes = np.unique(np.asarray(sizes,dtype=np.int64))
+    self.keys = np.unique(np.frombuffer(b''.join(q[:8] for q in qhashes),
+        dtype=np.int64))
+    self.added_sizes = set()
+    self.added_keys = set()
+
+  @classmethod
+  def load(cls,db,version):
+    """
+    Loads the filter of the files of the db hashed with the given
+    version (see hashing.hash_version)
+    """
+    cur = db.execute("""SELECT size,qhash FROM files WHERE hash_algo = ?
+    AND qhash IS NOT NULL""",(version,))
+    rows = cur.fetchall()
+    return cls([r[0] for r in rows],[r[1] for r in rows])
+
+  @staticmethod
+  def _contains(a,v):
+    i = np.searchsorted(a,v)
+    return bool(i < len(a) and a[i] == v)
+
+  def add(self,size,qhash):
+    self.added_sizes.add(size)
+    self.added_keys.add(qhash_key(qhash))
+
+  def may_have_size(self,size):
+    return size in self.added_sizes or self._contains(self.sizes,size)
+
+  def may_have(self,size,qhash):
+    key = qhash_key(qhash)
+    return self.may_have_size(size) and \
+        (key in self.added_keys or self._contains(self.keys,key))
+
+  def __len__(self):
+    return len(self.keys)
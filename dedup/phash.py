@@ -0,0 +1,169 @@
+from itertools import combinations
+import cv2
+import numpy as np
+
+# The 64 bits hashes are split in PARTS parts of PART_BITS bits
+# for the multi-index hashing
+PARTS = 4
+PART_BITS = 16
+PART_MASK = (1 << PART_BITS)-1
+
+
+def dhash(img):
+  """
+  Returns the 64 bits difference hash of a decoded (BGR) image
+
+  Each bit tells if a pixel of the 9x8 grayscale thumbnail is brighter
+  than its left neighbor. It is returned as a signed int, to fit in SQLite
+  """
+  g = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+  t = cv2.resize(g,(9,8),interpolation=cv2.INTER_AREA)
+  bits = (t[:,1:] > t[:,:-1]).flatten()
+  return int(np.packbits(bits).view('>i8')[0])
+
+
+def distance(a,b):
+  """
+  Returns the number of different bits between two hashes
+  """
+  return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def popcount(a):
+  """
+  Number of bits set in each element of a uint64 array
+  """
+  a = np.ascontiguousarray(a,dtype=np.uint64)
+  if hasattr(np,'bitwise_count'): # numpy >= 2.0
+    return np.bitwise_count(a).astype(np.int64)
+  return np.unpackbits(a.view(np.uint8).reshape(-1,8),axis=1).sum(
+      axis=1,dtype=np.int64)
+
+
+def part(h,i):
+  """
+  Returns the i-th part of a hash (can be an int or a numpy array)
+  """
+  return (h >> (PART_BITS*(PARTS-1-i))) & PART_MASK
+
+
+def part_sql(i,col='phash'):
+  """
+  SQL expression of the i-th part of the hash (must match part)
+
+  The same expression is used for the indexes and the queries
+  """
+  return f"(({col} >> {PART_BITS*(PARTS-1-i)}) & {PART_MASK})"
+
+
+def flips(r,bits=PART_BITS):
+  """
+  Returns the list of masks with at most r bits set among bits
+  """
+  return [sum(1 << b for b in c)
+      for n in range(r+1) for c in combinations(range(bits),n)]
+
+
+def _ranges(lo,hi):
+  """
+  Returns (i,j) arrays with j covering range(lo[i],hi[i]) for each i
+  """
+  cnt = hi-lo
+  i = np.repeat(np.arange(len(lo)),cnt)
+  j = np.arange(cnt.sum())-np.repeat(np.cumsum(cnt)-cnt,cnt)+lo[i]
+  return i,j
+
+
+class PHashIndex:
+  """
+  In-memory multi-index hashing of a set of hashes
+
+  Two hashes within k bits have at least one of their PARTS parts within
+  k//PARTS bits (pigeonhole principle): the candidates are found by
+  looking up each part and its close values in sorted arrays, and only
+  them are checked
+  """
+  def __init__(self,ids,hashes):
+    self.ids = np.asarray(ids,dtype=np.int64)
+    self.hashes = np.asarray(hashes,dtype=np.int64).view(np.uint64)
+    self.parts = []
+    for i in range(PARTS):
+      p = part(self.hashes,i).astype(np.int64)
+      order = np.argsort(p,kind='stable')
+      self.parts.append((p[order],order))
+
+  def _lookup(self,i,keys):
+    """
+    Returns the indices of the hashes with their i-th part in keys
+    """
+    p,order = self.parts[i]
+    _,j = _ranges(np.searchsorted(p,keys,side='left'),
+        np.searchsorted(p,keys,side='right'))
+    return order[j]
+
+  def query(self,h,k):
+    """
+    Returns the ids of the hashes within k bits of h and their distances
+    """
+    h = np.array([h],dtype=np.int64).view(np.uint64)[0]
+    masks = np.array(flips(k//PARTS),dtype=np.int64)
+    cand = np.unique(np.concatenate([
+      self._lookup(i,np.unique(int(part(h,i)) ^ masks))
+      for i in range(PARTS)]))
+    d = popcount(self.hashes[cand] ^ h)
+    keep = d <= k
+    return self.ids[cand[keep]],d[keep]
+
+  def pairs(self,k,new=None):
+    """
+    Returns (ida,idb,distance) arrays of all the pairs within k bits
+    (with ida < idb)
+
+    If new is given (a bool array, in the order of the ids), only the
+    pairs with at least one new hash are searched
+    """
+    found = [np.empty(0,dtype=np.int64)]
+    n = len(self.ids)
+    sel = np.arange(n) if new is None else np.nonzero(new)[0]
+    for i,(p,order) in enumerate(self.parts):
+      q = part(self.hashes[sel],i).astype(np.int64)
+      for mask in flips(k//PARTS):
+        # Pairs (a,b) such that part(a) ^ part(b) == mask
+        a,b = _ranges(np.searchsorted(p,q ^ mask,side='left'),
+            np.searchsorted(p,q ^ mask,side='right'))
+        a,b = sel[a],order[b]
+        keep = a < b if new is None else a != b
+        a,b = np.minimum(a[keep],b[keep]),np.maximum(a[keep],b[keep])
+        keep = popcount(self.hashes[a] ^ self.hashes[b]) <= k
+        # A pair can be found through several parts
+        found.append(a[keep]*n+b[keep])
+    found = np.unique(np.concatenate(found))
+    a,b = found//n,found % n
+    ida,idb = self.ids[a],self.ids[b]
+    return (np.minimum(ida,idb),np.maximum(ida,idb),
+        popcount(self.hashes[a] ^ self.hashes[b]))
+
+
+def clusters(ida,idb):
+  """
+  Returns the groups of ids connected by the pairs (ida[i],idb[i])
+  as a list of sorted lists, largest groups first
+  """
+  parent = {}
+
+  def find(x):
+    root = x
+    while parent.get(root,root) != root:
+      root = parent[root]
+    while x != root: # Path compression
+      parent[x],x = root,parent[x]
+    return root
+
+  for a,b in zip(ida.tolist(),idb.tolist()):
+    ra,rb = find(a),find(b)
+    if ra != rb:
+      parent[max(ra,rb)] = min(ra,rb)
+  groups = {}
+  for x in set(parent) | set(parent.values()):
+    groups.setdefault(find(x),[]).append(x)
+  return sorted((sorted(g) for g in groups.values()),key=lambda g:-len(g))
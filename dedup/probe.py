@@ -0,0 +1,58 @@
+import json
+import subprocess
+from fractions import Fraction
+from PIL import Image as PILImage
+
+
+def probe_image(path):
+  """
+  Reads the header of an image, returns a dict with its width, height
+  and format ('JPEG', 'PNG'...)
+
+  The pixels are not decoded
+  """
+  with PILImage.open(path) as img:
+    return dict(width=img.size[0],height=img.size[1],format=img.format)
+
+
+def _rate(s):
+  """
+  Parses a frame rate given by ffprobe ('30000/1001'), None if unknown
+  """
+  try:
+    r = Fraction(s)
+  except (TypeError,ValueError,ZeroDivisionError):
+    return None
+  return float(r) if r > 0 else None
+
+
+def probe_video(path,timeout=None):
+  """
+  Reads the container of a video with a single ffprobe call, returns a
+  dict with the height, width, duration (in s), frame_rate and codec of
+  its first video stream and the number of streams of the file
+
+  height, width and duration are 0 and codec is None if there is no
+  video stream, frame_rate and duration are None when unknown
+  ffprobe is killed after timeout seconds (raising TimeoutExpired)
+  """
+  r = subprocess.run(['ffprobe','-show_format','-show_streams','-of','json',
+    path],capture_output=True,timeout=timeout)
+  if r.returncode:
+    raise RuntimeError(f"ffprobe returned {r.returncode} on {path}: "
+        f"{r.stderr.decode(errors='replace').strip()[-200:]}")
+  p = json.loads(r.stdout)
+  vs = next((s for s in p['streams'] if s['codec_type'] == 'video'),None)
+  d = dict(height=0,width=0,duration=None,frame_rate=None,codec=None,
+      streams=len(p['streams']))
+  if vs is None:
+    d['duration'] = 0
+    return d
+  # The duration of the stream is not always set (mkv...)
+  duration = vs.get('duration',p.get('format',{}).get('duration'))
+  d.update(height=int(vs['height']),width=int(vs['width']),
+      duration=None if duration is None else float(duration),
+      frame_rate=_rate(vs.get('avg_frame_rate')) or _rate(
+        vs.get('r_frame_rate')),
+      codec=vs.get('codec_name'))
+  return d
@@ -0,0 +1,255 @@
+import os
+from itertools import count
+import numpy as np
+try:
+  import fcntl
+except ImportError: # Windows: each process writes to a new pack
+  fcntl = None
+
+PACK_EXT = '.pack'
+
+_stores = {}
+
+
+def get_store(directory,shape):
+  """
+  Returns the Store of the directory, one per process
+  """
+  key = (os.path.abspath(directory),tuple(shape))
+  if key not in _stores:
+    _stores[key] = Store(*key)
+  return _stores[key]
+
+
+def _after_fork():
+  """
+  Releases at once the packs inherited by a forked process
+  """
+  for store in _stores.values():
+    store._check_pid()
+
+
+if hasattr(os,'register_at_fork'):
+  os.register_at_fork(after_in_child=_after_fork)
+
+
+def _lock(f):
+  """
+  Takes the exclusive lock of an open pack without waiting
+
+  Returns False if another process holds it
+  """
+  if fcntl is None:
+    return True
+  try:
+    fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return True
+  except OSError:
+    return False
+
+
+class Store:
+  """
+  Append-only store of arrays of shape (t,)+shape (uint8), packed in a
+  few large files of the directory
+
+  An entry is located by the name of its pack, its offset in bytes and its
+  length t (the location is kept in the db). Entries are read as views
+  of a memmap of the pack, without copy.
+  Each process appends to a pack that it holds locked, so the workers
+  never write to the same pack (a forked process drops the pack and the
+  memmaps inherited from its parent, see _check_pid); the space of the entries that are not
+  referenced any more is reclaimed by compact
+  """
+  def __init__(self,directory,shape):
+    self.directory = directory
+    self.shape = tuple(shape)
+    self.frame = int(np.prod(self.shape))
+    self._maps = {}
+    self._pack = None # (name,file) to which this process appends
+    self._old = {} # The packs locked by compact
+    self._pid = os.getpid()
+
+  def _check_pid(self):
+    """
+    Drops the state inherited from the parent in a forked process (the
+    store is cached per process by get_store, so the workers of a Pool
+    inherit it): the pack of the parent must not be appended to
+    """
+    if self._pid != os.getpid():
+      self._pid = os.getpid()
+      self._pack = None # Unbuffered: its closing writes nothing
+      self._maps = {}
+      self._old = {}
+
+  def _path(self,pack):
+    return os.path.join(self.directory,pack)
+
+  def packs(self):
+    """
+    Returns the names of all the packs
+    """
+    if not os.path.isdir(self.directory):
+      return []
+    return sorted(f for f in os.listdir(self.directory)
+        if f.endswith(PACK_EXT))
+
+  def get(self,pack,offset,length):
+    """
+    Returns the entry at the given location as a read-only view
+    """
+    if not length:
+      return np.empty((0,)+self.shape,dtype=np.uint8)
+    end = offset+length*self.frame
+    self._check_pid()
+    m = self._maps.get(pack)
+    if m is None or len(m) < end: # The pack may have grown since mapped
+      m = self._maps[pack] = np.memmap(self._path(pack),dtype=np.uint8,
+          mode='r')
+    return m[offset:end].reshape((length,)+self.shape)
+
+  def _open(self):
+    """
+    Returns (name,file) of the pack this process appends to: the first
+    one that is not locked by another process, or a new one
+    """
+    self._check_pid()
+    if self._pack is not None:
+      return self._pack
+    os.makedirs(self.directory,exist_ok=True)
+    for pack in self.packs() if fcntl is not None else []:
+      f = open(self._path(pack),'ab',buffering=0)
+      if _lock(f):
+        self._pack = (pack,f)
+        return self._pack
+      f.close()
+    for i in count(len(self.packs())):
+      pack = f"{i:04d}{PACK_EXT}"
+      try:
+        f = open(self._path(pack),'xb',buffering=0)
+      except FileExistsError: # Created by another process
+        continue
+      if _lock(f):
+        self._pack = (pack,f)
+        return self._pack
+      f.close()
+
+  def writer(self):
+    """
+    Returns an EntryWriter appending a new entry
+    """
+    return EntryWriter(self,*self._open())
+
+  def append(self,a):
+    """
+    Appends the array and returns its location (pack,offset,length)
+    """
+    with self.writer() as w:
+      w.write(a)
+    return w.location
+
+  def close(self):
+    """
+    Releases the pack of this process and the memmaps
+    """
+    self._check_pid()
+    if self._pack is not None:
+      self._pack[1].close()
+      self._pack = None
+    self._maps = {}
+
+  def compact(self,entries):
+    """
+    Copies the given entries, as a dict {key: location}, to a new pack
+    and returns their new locations as a dict {key: location}
+
+    Only the packs that are not used by another process are compacted:
+    the entries in the other ones are not moved. The old packs must be
+    removed with remove_packs once the new locations are saved
+    """
+    self.close()
+    locked = {}
+    for pack in self.packs():
+      f = open(self._path(pack),'ab')
+      if _lock(f):
+        locked[pack] = f
+      else:
+        f.close()
+    new = {}
+    w = None
+    try:
+      # The entries are copied in the order of the old packs
+      for key,(pack,offset,length) in sorted(entries.items(),
+          key=lambda t:t[1]):
+        if pack not in locked:
+          continue
+        if w is None:
+          w = self.writer()
+          locked.pop(w.pack,None) # The new pack is not removed
+        with w.entry():
+          w.write(self.get(pack,offset,length))
+        new[key] = w.location
+    finally:
+      self._maps = {}
+    self._old = locked
+    return new
+
+  def remove_packs(self):
+    """
+    Removes the packs compacted by the last call to compact
+    and returns the number of bytes freed
+    """
+    freed = 0
+    for pack,f in self._old.items():
+      freed += os.path.getsize(self._path(pack))
+      os.remove(self._path(pack))
+      f.close()
+    self._old = {}
+    self.close()
+    return freed
+
+
+class EntryWriter:
+  """
+  Writes an entry of a Store one chunk at a time
+
+  The location of the entry is available once closed.
+  An aborted entry is truncated from the pack
+  """
+  def __init__(self,store,pack,f):
+    self.store = store
+    self.pack = pack
+    self.f = f
+    self.entry()
+
+  def entry(self):
+    """
+    Starts a new entry after the previous one (to write several entries
+    with the same writer)
+    """
+    self.offset = self.f.seek(0,os.SEEK_END)
+    self.length = 0
+    self.location = None
+    return self
+
+  def write(self,a):
+    assert a.shape[1:] == self.store.shape,f"Invalid shape: {a.shape}"
+    self.f.write(np.ascontiguousarray(a,dtype=np.uint8).tobytes())
+    self.length += a.shape[0]
+
+  def close(self):
+    self.f.flush()
+    self.location = (self.pack,self.offset,self.length)
+
+  def abort(self):
+    self.f.flush()
+    self.f.truncate(self.offset)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,*_):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
@@ -1,24 +1,150 @@
-import os
+import subprocess
+import threading
 import numpy as np
 import ffmpeg
+try:
+  import resource
+except ImportError: # Windows: the memory of ffmpeg is not limited
+  resource = None
 
 from .file import File,VIDEO
+from .store import get_store
+from .probe import probe_video
 
 Y,X = 27,48
 fps = 2
+FRAME = Y*X*3 # Size of a frame in bytes
+# Minimal average difference (0-255) between two consecutive frames
+# of the fingerprint to detect a shot change
+cut_threshold = 30
+# Modes of the fingerprint (see read_frames)
+MODES = ['full','keyframes','auto']
+# In auto mode, only the keyframes of the videos longer than this
+# (in seconds) are decoded
+keyframes_min_duration = 600
 
 
-def mkarr(v):
+def _limit_memory(max_memory):
   """
-  Computes and returns the Numpy fingerprint of a video
-  Warning ! It will be entirely saved to RAM, so make sure it can fit...
+  Returns a function limiting the address space of the process to
+  max_memory MiB, to be called in a child process before it starts
   """
-  h,w,_ = get_res(v)
-  out,_ = ffmpeg.input(v)\
-  .output('pipe:', format='rawvideo', pix_fmt='rgb24',s=f'{X}x{Y}',r=2)\
-  .run(capture_stdout=True)
-  v = np.frombuffer(out, np.uint8).reshape([-1,Y,X,3])
-  return v
+  if not max_memory or resource is None:
+    return None
+  def limit():
+    b = int(max_memory)*2**20
+    resource.setrlimit(resource.RLIMIT_AS,(b,b))
+  return limit
+
+
+def read_frames(v,n=1,mode='full',duration=None,timeout=None,
+    max_memory=None):
+  """
+  Generator yielding the frames of the fingerprint of a video
+  as (n,Y,X,3) arrays (the last one may be shorter)
+
+  Only n frames are held in RAM at once
+  In 'keyframes' mode, the decoder skips all the frames but the keyframes,
+  which are repeated to keep fps frames per second: the fingerprint has
+  the same length as in 'full' mode, at a fraction of the decoding cost
+  (the last keyframe would be repeated for a whole GOP: the output is
+  cut at duration seconds if given)
+
+  ffmpeg is killed if it runs for more than timeout seconds (raising
+  TimeoutError) and cannot use more than max_memory MiB (it fails)
+  """
+  opts,out = {},{}
+  if mode == 'keyframes':
+    opts['skip_frame'] = 'nokey'
+    if duration:
+      out['t'] = duration
+  args = ffmpeg.input(v,**opts)\
+  .output('pipe:', format='rawvideo', pix_fmt='rgb24',s=f'{X}x{Y}',r=fps,
+      **out)\
+  .compile()
+  # ffmpeg reads its commands on stdin: it must not take the terminal
+  proc = subprocess.Popen(args,stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,preexec_fn=_limit_memory(max_memory))
+  timer = None
+  if timeout:
+    timer = threading.Timer(timeout,proc.kill)
+    timer.start()
+  try:
+    while True:
+      buf = proc.stdout.read(n*FRAME)
+      k = len(buf)//FRAME
+      if k:
+        yield np.frombuffer(buf[:k*FRAME],np.uint8).reshape(k,Y,X,3)
+      if k < n:
+        break
+    if proc.wait():
+      if timer is not None and timer.finished.is_set():
+        raise TimeoutError(f"ffmpeg killed after {timeout}s on {v}")
+      raise RuntimeError(f"ffmpeg returned {proc.returncode} on {v}")
+  finally:
+    if timer is not None:
+      timer.cancel()
+    if proc.poll() is None: # The generator was closed early
+      proc.kill()
+      proc.wait()
+    proc.stdout.close()
+
+
+def find_cuts(diffs,threshold=None):
+  """
+  Returns the indices of the frames starting a new shot, given the
+  average absolute difference of each frame with the previous one
+
+  A cut is a difference of at least threshold (cut_threshold by default)
+  and twice the ones of the neighbor frames (motion spans several frames)
+  """
+  if threshold is None:
+    threshold = cut_threshold
+  d = np.asarray(diffs,dtype=np.float64)
+  if not len(d):
+    return np.empty(0,dtype=np.uint32)
+  neighbors = np.maximum(np.r_[0,d[:-1]],np.r_[d[1:],0])
+  return (np.nonzero((d >= threshold) & (d >= 2*neighbors))[0]+1).astype(
+      np.uint32)
+
+
+def fingerprint(v,writer=None,factor=5,mode='full',duration=None,
+    timeout=None,max_memory=None):
+  """
+  Streams the video and returns its (t//factor,3) color signal (see to1d)
+  and the indices of the frames starting a new shot (see find_cuts)
+
+  If a writer is given (a store.EntryWriter), the full fingerprint is
+  written to it and it is closed.
+  The memory usage does not depend on the length of the video.
+  mode, duration, timeout and max_memory are given to read_frames.
+  In 'keyframes' mode, no shot is returned: the repeated keyframes would
+  be taken for cuts
+  """
+  sig = []
+  diffs = []
+  last = None
+  try:
+    for a in read_frames(v,factor,mode,duration,timeout,max_memory):
+      if writer is not None:
+        writer.write(a)
+      if len(a) == factor:
+        sig.append(to1d(a,factor))
+      b = a.astype(np.int16)
+      if last is not None:
+        b = np.concatenate([last[None],b])
+      diffs.append(np.abs(np.diff(b,axis=0)).mean(axis=(1,2,3)))
+      last = b[-1]
+  except BaseException:
+    if writer is not None:
+      writer.abort()
+    raise
+  if writer is not None:
+    writer.close()
+  cuts = find_cuts(np.concatenate(diffs) if diffs and mode == 'full'
+      else [])
+  return (np.concatenate(sig) if sig else np.empty((0,3),dtype=np.uint8),
+      cuts)
 
 
 def to1d(a,factor=5):
@@ -34,36 +160,111 @@ def to1d(a,factor=5):
 def get_res(v):
   """
   Read the resolution and length of the video at the given path
+  (see probe.probe_video to get all the metadata)
   """
-  p = ffmpeg.probe(v)
-  vs = next((stream for stream in
-    p['streams'] if stream['codec_type'] == 'video'),None)
-  return (int(vs['height']),int(vs['width']),int(float(vs['duration'])))
+  p = probe_video(v)
+  return (p['height'],p['width'],int(p['duration'] or 0))
 
 
 class Video(File):
-  def __init__(self,path,signature_path,**kwargs):
-    for kw in ['_height','_width','_length','sigrgb']:
+  def __init__(self,path,store,**kwargs):
+    for kw in ['_height','_width','_length','sigrgb','shots','location',
+        'duration','frame_rate','codec','streams','probed','sig_mode',
+        'sig_error']:
       setattr(self,kw,kwargs.pop(kw.strip('_'),None))
+    # Mode of the next fingerprint (see MODES), sig_mode is the mode
+    # of the current one
+    self.mode = kwargs.pop('mode','full')
+    # Limits of ffprobe and ffmpeg (see read_frames)
+    self.timeout = kwargs.pop('timeout',None)
+    self.max_memory = kwargs.pop('max_memory',None)
     self._signature = None
-    self.signature_path = signature_path
+    self.store = store # Directory of the store of the full signatures
     File.__init__(self,path,**kwargs)
     self.type = VIDEO
 
   def compute_attrs(self):
+    """
+    Probes the video once for all its metadata (see probe.probe_video)
+
+    probed is the (size,mtime) of the file when it was probed: the
+    metadata kept in the db is reused as long as the file does not change.
+    It stays None if the probe failed (it may be transient, like a
+    timeout): the video is probed again next time
+    """
+    probed = (self.size,self.mtime)
+    try:
+      meta = probe_video(self.path,self.timeout)
+    except Exception as e:
+      print(f"[Video] Error processing {self.path}: {type(e).__name__}: {e}")
+      meta = dict(height=0,width=0,duration=0,frame_rate=None,codec=None,
+          streams=None)
+      probed = None
+    self._height,self._width = meta['height'],meta['width']
+    self._length = int(meta['duration'] or 0)
+    self.duration = meta['duration']
+    self.frame_rate = meta['frame_rate']
+    self.codec = meta['codec']
+    self.streams = meta['streams']
+    self.probed = probed
+
+  def set_attrs(self,probed,**meta):
+    """
+    Sets the metadata probed earlier (see compute_attrs)
+    """
+    for kw,v in meta.items():
+      setattr(self,'_'+kw if kw in ['height','width','length'] else kw,v)
+    self.probed = probed
+
+  def compute_signatures(self,mode=None):
+    """
+    Computes sigrgb and shots (the frames of the full signature starting
+    a new shot) and appends the full signature to the store
+    (location is its location in the store)
+
+    The video is streamed, so the signature is never entirely in RAM
+    ffmpeg is not started for the files with no video stream
+    (known from the metadata, probed if needed)
+    The fingerprint is made in the given mode, self.mode by default
+    (see MODES, sig_mode is set to the actual mode)
+    If it fails (or exceeds the limits), the error is kept in sig_error
+    and the signatures are None
+    """
+    mode = mode or self.mode
+    assert mode in MODES,f"Invalid mode: {mode}"
+    self._signature = None
+    store = get_store(self.store,(Y,X,3))
+    if self.height == 0 and self.streams is not None and self.codec is None:
+      self.sigrgb = np.empty((0,3),dtype=np.uint8)
+      self.shots = find_cuts([])
+      self.location = store.append(np.empty((0,Y,X,3),dtype=np.uint8))
+      self.sig_mode = 'full'
+      self.sig_error = None
+      return
+    if mode == 'auto':
+      mode = 'keyframes' if (self.duration or self.length) >= \
+          keyframes_min_duration else 'full'
+    w = store.writer()
     try:
-      self._height,self._width,self._length = get_res(self.path)
+      self.sigrgb,self.shots = fingerprint(self.path,w,mode=mode,
+          duration=self.duration,timeout=self.timeout,
+          max_memory=self.max_memory)
     except Exception as e:
       print(f"[Video] Error processing {self.path}: {type(e).__name__}: {e}")
-      self._height, self._width = 0,0
-      self._length = 0
+      self.sigrgb = self.shots = self.location = None
+      self.sig_error = f"{type(e).__name__}: {e}"
+      return
+    self.location = w.location
+    self.sig_mode = mode
+    self.sig_error = None
 
-  def compute_signatures(self):
-    self._signature = mkarr(self.path)
-    #d = vid_library_path+os.path.dirname(self.path)
-    #os.makedirs(d,exist_ok=True)
-    #np.save(d+os.basename(self.path)+'.npy')
-    self.sigrgb = to1d(self._signature)
+  @property
+  def cost(self):
+    """
+    Expected cost of the fingerprint, to schedule the longest ones first:
+    the duration in seconds (estimated from the size at 1 MiB/s if unknown)
+    """
+    return self.duration or self._length or self.size/2**20
 
   @property
   def height(self):
@@ -85,6 +286,6 @@ class Video(File):
 
   @property
   def signature(self):
-    if self._signature is None and os.path.exists(self.signature_path):
-      self._signature = np.load(self.signature_path)
+    if self._signature is None and self.location is not None:
+      self._signature = get_store(self.store,(Y,X,3)).get(*self.location)
     return self._signature
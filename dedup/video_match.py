@@ -0,0 +1,270 @@
+from itertools import product
+import numpy as np
+
+from .video import fps
+
+# Duration of a sample of sigrgb in seconds (see video.fingerprint)
+period = 5/fps
+# Number of gaps between cuts in a key of the shot index and bits of each
+SHOT_GAPS = 3
+GAP_BITS = 20
+
+
+def _pow2(n):
+  """
+  Smallest power of 2 >= n
+  """
+  return 1 << max(int(n)-1,0).bit_length()
+
+
+def downsample(sig,factor):
+  """
+  Averages the samples of a (t,3) signal by groups of factor
+  """
+  t = len(sig)//factor
+  return sig[:t*factor].reshape(t,factor,3).mean(axis=1)
+
+
+def _prepare(sigs):
+  """
+  Returns the lengths, the centered signals and their norms
+  """
+  lens = np.array([len(s) for s in sigs],dtype=np.int64)
+  centered = [s.astype(np.float64)-s.mean(axis=0) if len(s) else s
+      for s in sigs]
+  norms = np.array([np.sqrt((c**2).sum()) for c in centered])
+  return lens,centered,norms
+
+
+def _transform(centered,lens,q,size):
+  """
+  Returns the conjugate FFTs of the size samples of the signals of q
+  (zero padded) as a (len(q),3,size//2+1) array
+  """
+  a = np.zeros((len(q),3,size))
+  for r,i in enumerate(q):
+    a[r,:,:lens[i]] = centered[i].T
+  return np.fft.rfft(a,axis=2).conj()
+
+
+def _search(sigs,min_len,min_score,block,new=None):
+  """
+  Compares every signal with all the longer ones (see included_pairs)
+  """
+  lens,centered,norms = _prepare(sigs)
+  order = np.argsort(lens,kind='stable')
+  order = order[(lens[order] >= min_len) & (norms[order] > 0)]
+  starts = np.searchsorted(lens[order],[_pow2(n) for n in lens[order]],
+      side='right')
+  if new is None:
+    new = np.ones(len(sigs),dtype=bool)
+  # Number of new signals from each position of the order
+  later = np.concatenate([np.cumsum(new[order][::-1])[::-1],[0]])
+  for k in range(0,len(order)-1,block):
+    q = order[k:k+block]
+    if not new[q].any() and not later[k+1]:
+      continue
+    # Each long signal b uses the FFT size of its length: the queries are
+    # transformed once for all the b sharing this size
+    jpos = k+1
+    while jpos < len(order):
+      size = _pow2(lens[order[jpos]])
+      end = starts[jpos]
+      if not new[q[:end-1-k]].any() and later[jpos] == later[end]:
+        jpos = end # Only known pairs
+        continue
+      # The queries of the last b of this size
+      fa = _transform(centered,lens,q[:end-1-k],size)
+      for j in range(jpos,end):
+        # Only the signals before b in the order, and only the new ones
+        # if b is not new
+        r = np.arange(min(j-k,len(q)))
+        if not new[order[j]]:
+          r = r[new[q[r]]]
+          if not len(r):
+            continue
+        yield _correlate(sigs[order[j]],order[j],q[r],fa[r],
+            lens,norms,size,min_score)
+      jpos = end
+
+
+def included_pairs(sigs,min_len=12,min_score=0.9,coarse=4,margin=0.15,
+    block=256,new=None):
+  """
+  Finds the color signals (see video.to1d) contained in longer ones
+
+  sigs is a list of (t,3) arrays. Each signal a is compared with all the
+  signals b at least as long: the normalized cross-correlation of a with
+  every window of len(a) samples of b is computed at once with FFTs,
+  and the best window is kept if its score is at least min_score.
+  Signals shorter than min_len samples or constant are skipped
+
+  The search is first made on the signals averaged by groups of coarse
+  samples, keeping the pairs with a score of at least min_score-margin,
+  then only these pairs are compared at full resolution
+  (coarse=1 compares all the pairs at full resolution)
+  If new is given (a bool array), only the pairs with at least one new
+  signal are compared
+
+  Yields (ia,ib,score,offset) arrays: sigs[ia] matches
+  sigs[ib][offset:offset+len(sigs[ia])] with a score between -1 and 1
+  """
+  if coarse <= 1:
+    yield from _search(sigs,min_len,min_score,block,new)
+    return
+  pairs = []
+  for ia,ib,_,_ in _search([downsample(s,coarse) for s in sigs],
+      max(min_len//coarse,2),min_score-margin,block,new):
+    pairs += zip(ia.tolist(),ib.tolist())
+  yield from match_pairs(sigs,pairs,min_len,min_score)
+
+
+def match_pairs(sigs,pairs,min_len=12,min_score=0.9):
+  """
+  Same as included_pairs, but only for the given pairs of indices of sigs
+  (in any order: the shorter signal is searched in the longer one)
+  """
+  lens,centered,norms = _prepare(sigs)
+  cand = {}
+  for a,b in pairs:
+    if (lens[a],a) > (lens[b],b):
+      a,b = b,a
+    if a != b and lens[a] >= min_len and norms[a] > 0 and norms[b] > 0:
+      cand.setdefault(b,set()).add(a)
+  for ib,q in cand.items():
+    q = np.array(sorted(q),dtype=np.int64)
+    size = _pow2(lens[ib])
+    yield _correlate(sigs[ib],ib,q,_transform(centered,lens,q,size),
+        lens,norms,size,min_score)
+
+
+def _correlate(b,ib,q,fa,lens,norms,size,min_score):
+  """
+  Returns the best match of each signal of q in b (see included_pairs)
+
+  fa holds the conjugate FFTs of the centered signals of q, as a
+  (len(q),3,size//2+1) array
+  """
+  n = len(b)
+  b = b.astype(np.float64)
+  fb = np.fft.rfft(b,size,axis=0).T
+  # The channels are summed in the frequency domain: a single inverse FFT
+  num = np.fft.irfft(fa[:,0]*fb[0]+fa[:,1]*fb[1]+fa[:,2]*fb[2],size,axis=1)
+  m = lens[q][:,None]
+  width = n-m.min()+1 # Number of offsets of the shortest signal
+  o = np.arange(width)
+  end = np.minimum(o+m,n)
+  # Variance of each window of b, from the cumulative sums
+  cs1 = np.concatenate([np.zeros((3,1)),np.cumsum(b.T,axis=1)],axis=1)
+  cs2 = np.concatenate([[0],np.cumsum((b**2).sum(axis=1))])
+  var = cs2[end]-cs2[o]
+  for c in cs1:
+    s1 = c[end]-c[o]
+    var -= s1*s1/m
+  score = num[:,:width]/np.sqrt(np.maximum(var,1e-9))
+  score[o > n-m] = -np.inf
+  best = score.argmax(axis=1)
+  score = score[np.arange(len(q)),best]/norms[q]
+  keep = score >= min_score
+  return q[keep],np.full(keep.sum(),ib),score[keep],best[keep]
+
+
+def shot_keys(cuts):
+  """
+  Returns the keys of the shot index of a video and the frame of the
+  first cut of each key, given the frames starting its shots
+  (see video.find_cuts)
+
+  Each key packs the SHOT_GAPS gaps (in frames) between consecutive cuts:
+  it does not depend on the position of the cuts in the video
+  """
+  cuts = np.asarray(cuts,dtype=np.int64)
+  gaps = np.minimum(np.diff(cuts),(1 << GAP_BITS)-2)
+  k = len(gaps)-SHOT_GAPS+1
+  if k <= 0:
+    return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64)
+  keys = np.zeros(k,dtype=np.int64)
+  for i in range(SHOT_GAPS):
+    keys |= gaps[i:i+k] << (GAP_BITS*i)
+  return keys,cuts[:k]
+
+
+def probe_keys(keys,tolerance=1):
+  """
+  Returns the keys to look up for each key: all the keys with gaps within
+  tolerance frames (a cut can move by a frame when the video is sampled
+  at other times), along with the index of the key they come from
+  """
+  deltas = np.array(list(product(range(-tolerance,tolerance+1),
+      repeat=SHOT_GAPS)),dtype=np.int64)
+  shifts = (deltas << (GAP_BITS*np.arange(SHOT_GAPS))).sum(axis=1)
+  probes = (keys[:,None]+shifts[None]).ravel()
+  return probes,np.repeat(np.arange(len(keys)),len(shifts))
+
+
+def vote(frames,src,ids,other_frames,top=10,min_votes=2,bin_size=4):
+  """
+  Ranks the candidates of a video given the matches of its keys
+
+  frames are the frames of the keys of the video, and each match is a key
+  of the index with the number of the key it matches in src,
+  the id of its video in ids and its frame in other_frames.
+  Each key votes once for the offset between the videos (in bins of
+  bin_size frames) of each of its matches
+
+  Returns a list of (id,votes,offset) for the top candidates with at least
+  min_votes votes for the same offset, best first: frame f of the video
+  matches frame f+offset of the candidate
+  """
+  if not len(src):
+    return []
+  offsets = other_frames-frames[src]
+  bins = np.floor_divide(offsets,bin_size)
+  # Sorted by (id,bin,key), one vote per key for each (id,bin)
+  order = np.lexsort((src,bins,ids))
+  ids,bins,src,offsets = ids[order],bins[order],src[order],offsets[order]
+  new_bin = np.r_[True,(ids[1:] != ids[:-1]) | (bins[1:] != bins[:-1])]
+  first = new_bin | np.r_[True,src[1:] != src[:-1]]
+  ids,offsets,new_bin = ids[first],offsets[first],new_bin[first]
+  starts = np.nonzero(new_bin)[0]
+  votes = np.diff(np.r_[starts,len(ids)])
+  keep = votes >= min_votes
+  starts,votes = starts[keep],votes[keep]
+  if not len(starts):
+    return []
+  # The best bin of each id
+  order = np.lexsort((-votes,ids[starts]))
+  starts,votes = starts[order],votes[order]
+  best = np.r_[True,ids[starts[1:]] != ids[starts[:-1]]]
+  starts,votes = starts[best],votes[best]
+  r = []
+  for k in np.argsort(-votes,kind='stable')[:top].tolist():
+    o = offsets[starts[k]:starts[k]+votes[k]]
+    r.append((int(ids[starts[k]]),int(votes[k]),int(np.median(o))))
+  return r
+
+
+class ShotIndex:
+  """
+  In-memory copy of the shot index, to find the candidates of many videos
+  """
+  def __init__(self,keys,ids,frames):
+    order = np.argsort(keys,kind='stable')
+    self.keys = np.asarray(keys)[order]
+    self.ids = np.asarray(ids)[order]
+    self.frames = np.asarray(frames)[order]
+
+  def candidates(self,vid,cuts,top=10,min_votes=2):
+    """
+    Returns the top candidates of the video of id vid (see vote)
+    """
+    keys,frames = shot_keys(cuts)
+    probes,src = probe_keys(keys)
+    lo = np.searchsorted(self.keys,probes,side='left')
+    hi = np.searchsorted(self.keys,probes,side='right')
+    cnt = hi-lo
+    i = np.repeat(np.arange(len(probes)),cnt)
+    j = np.arange(cnt.sum())-np.repeat(np.cumsum(cnt)-cnt,cnt)+lo[i]
+    keep = self.ids[j] != vid
+    i,j = i[keep],j[keep]
+    return vote(frames,src[i],self.ids[j],self.frames[j],top,min_votes)
@@ -0,0 +1,74 @@
+import os
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
+
+from .file import stat_key
+
+
+def is_excluded(name,rel,exclusion):
+  """
+  Returns True if the file or folder matches one of the exclusion patterns
+
+  The patterns (fnmatch style) are tested against the name and the path
+  relative to the root dir, for example '*.tmp', '.git' or 'cache/*'
+  """
+  for pattern in exclusion:
+    if fnmatch(name,pattern) or fnmatch(rel,pattern):
+      return True
+  return False
+
+
+def scan_dir(d,root,exclusion=()):
+  """
+  Lists a single folder
+
+  Returns ([(path,stat_key),...],[subfolders])
+  The stat data comes from the DirEntry objects, so each file is
+  stat'ed only once and the folders are not stat'ed at all on most systems
+  """
+  files,dirs = [],[]
+  try:
+    with os.scandir(d) as it:
+      for entry in it:
+        rel = entry.path[len(root)+1:]
+        if exclusion and is_excluded(entry.name,rel,exclusion):
+          continue
+        try:
+          # Symlinks to folders are not followed to avoid loops
+          if entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.path)
+          elif entry.is_file():
+            files.append((entry.path,stat_key(entry.stat())))
+        except OSError: # Removed since the listing, broken link...
+          pass
+  except OSError as e:
+    print(f"[Walk] Error listing {d}: {type(e).__name__}: {e}")
+  return files,dirs
+
+
+def walk(d,exclusion=(),threads=0):
+  """
+  Generator yielding (path,stat_key) for all the files in the folder
+  (recursively), paths are absolute
+
+  The files are yielded as soon as their folder is listed, so they can be
+  processed while the walk goes on
+  If threads > 1, several folders are listed at once (useful for network
+  drives with a high latency), the order of the files is then undefined
+  """
+  root = os.path.abspath(d)
+  if threads <= 1:
+    stack = [root]
+    while stack:
+      files,dirs = scan_dir(stack.pop(),root,exclusion)
+      yield from files
+      stack.extend(reversed(dirs))
+    return
+  with ThreadPoolExecutor(threads) as ex:
+    pending = {ex.submit(scan_dir,root,root,exclusion)}
+    while pending:
+      done,pending = wait(pending,return_when=FIRST_COMPLETED)
+      for fut in done:
+        files,dirs = fut.result()
+        pending.update(ex.submit(scan_dir,sub,root,exclusion) for sub in dirs)
+        yield from files
@@ -0,0 +1,38 @@
+import argparse
+
+from .database import Database
+
+
+def main(argv=None):
+  """
+  Entry point of the worker: python -m dedup.worker config.cfg [options]
+
+  Several workers can run at once, on one or several machines
+  """
+  parser = argparse.ArgumentParser(prog='python -m dedup.worker',
+      description="Computes the signatures queued in the db")
+  parser.add_argument('config',help="config file (the db_file, root_dir "
+      "and vid_library must be shared by all the workers)")
+  parser.add_argument('--batch',type=int,default=16,
+      help="number of files claimed at once")
+  parser.add_argument('--lease',type=float,default=300,
+      help="seconds before the jobs of a stopped worker are given again")
+  parser.add_argument('--wait',type=float,default=0,
+      help="keep waiting for the jobs of the other workers, checking "
+      "every WAIT seconds (0: stop when no job is available)")
+  parser.add_argument('--processes',type=int,default=None,
+      help="number of worker processes (default: number of CPUs)")
+  parser.add_argument('--remap',nargs=2,metavar=('OLD','NEW'),
+      help="replace the prefix OLD of the paths of the db by NEW")
+  parser.add_argument('--queue',action='store_true',
+      help="queue all the missing signatures before starting")
+  args = parser.parse_args(argv)
+  with Database(args.config,args.processes) as db:
+    if args.queue:
+      print(f"{db.queue_signatures()} jobs queued")
+    n = db.process_jobs(args.batch,args.lease,args.wait,args.remap)
+  print(f"Done, {n} files processed")
+
+
+if __name__ == '__main__':
+  main()
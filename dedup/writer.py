@@ -0,0 +1,41 @@
+from time import monotonic
+
+
+class Writer:
+  """
+  Single writer of the db: gathers the rows to write and writes them with
+  executemany, in one transaction per batch
+
+  A batch is written when it holds max_rows rows or when max_delay seconds
+  have passed since the previous one. The order of the rows is only kept
+  for each statement
+  """
+  def __init__(self,db,max_rows=1000,max_delay=5):
+    self.db = db
+    self.max_rows = max_rows
+    self.max_delay = max_delay
+    self.pending = {}
+    self.count = 0
+    self.last = monotonic()
+
+  def add(self,sql,row):
+    self.pending.setdefault(sql,[]).append(row)
+    self.count += 1
+    if self.count >= self.max_rows or monotonic()-self.last >= self.max_delay:
+      self.flush()
+
+  def flush(self):
+    if self.pending:
+      with self.db: # Commits, or rolls back if anything fails
+        cur = self.db.cursor()
+        for sql,rows in self.pending.items():
+          cur.executemany(sql,rows)
+      self.pending = {}
+      self.count = 0
+    self.last = monotonic()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*_):
+    self.flush()
@@ -0,0 +1,60 @@
+import os
+import sys
+import signal
+import socket
+import sqlite3
+import subprocess
+from time import sleep
+import cv2
+import numpy as np
+
+from dedup import Database
+
+LEASE = 1
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _worker(cfg,*args):
+  """
+  Starts python -m dedup.worker on the config
+  """
+  env = dict(os.environ,PYTHONPATH=ROOT)
+  return subprocess.Popen([sys.executable,'-m','dedup.worker',cfg,
+      '--batch','4','--lease',str(LEASE),'--processes','1',*args],env=env,
+      stdout=subprocess.DEVNULL)
+
+
+def test_killed_worker(tmp_path,monkeypatch):
+  rng = np.random.default_rng(0)
+  n = 60
+  os.makedirs(tmp_path/'d')
+  for i in range(n):
+    cv2.imwrite(str(tmp_path/'d'/f"{i}.png"),
+        rng.integers(0,256,(64,64,3),dtype=np.uint8))
+  cfg = str(tmp_path/'test.cfg')
+  with open(cfg,'w') as f:
+    f.write(f"root_dir='{tmp_path}/d'\ndb_file='{tmp_path}/test.db'\n"
+        f"vid_library='{tmp_path}/vid'\nvid_ext=['mp4']\nimg_ext=['png']\n")
+  monkeypatch.setattr('builtins.input',lambda *_: 'y')
+  with Database(cfg,1) as db:
+    db.reset()
+    db.detect_and_add()
+    assert db.queue_signatures() == n
+  victim = _worker(cfg)
+  db = sqlite3.connect(str(tmp_path/'test.db'),timeout=60)
+  # Killed once it holds a lease: its jobs are given again when it expires
+  held = []
+  while not held:
+    assert victim.poll() is None,"The worker ended before being killed"
+    sleep(0.01)
+    held = db.execute("SELECT id FROM jobs WHERE worker = ?",
+        (f"{socket.gethostname()}:{victim.pid}",)).fetchall()
+  os.kill(victim.pid,signal.SIGKILL)
+  victim.wait()
+  workers = [_worker(cfg,'--wait','0.1') for _ in range(3)]
+  for w in workers:
+    assert w.wait(120) == 0
+  assert db.execute("SELECT count(*) FROM jobs").fetchone()[0] == 0
+  assert db.execute("""SELECT count(*) FROM img
+  WHERE signature IS NOT NULL""").fetchone()[0] == n
+  db.close()
@@ -0,0 +1,49 @@
+import time
+import multiprocessing
+import numpy as np
+
+from dedup import store
+
+SHAPE = (2,3,3)
+
+
+def _entry(i):
+  return np.full((i%5+1,)+SHAPE,i%256,dtype=np.uint8)
+
+
+def _stream(args):
+  """
+  Streams an entry one frame at a time from a worker, aborting one entry
+  out of three before writing the kept one
+  """
+  directory,i = args
+  s = store.get_store(directory,SHAPE)
+  if i%3 == 0:
+    try:
+      with s.writer() as w:
+        w.write(_entry(i+1)[:1])
+        raise ValueError
+    except ValueError:
+      pass
+  a = _entry(i)
+  with s.writer() as w:
+    for frame in a:
+      w.write(frame[None])
+      time.sleep(0.001) # Lets the other workers write meanwhile
+  return i,w.location
+
+
+def test_workers_forked_after_append(tmp_path):
+  directory = str(tmp_path)
+  s = store.get_store(directory,SHAPE)
+  locations = {-1:s.append(_entry(7))}
+  # The workers inherit the store and its pack from the parent
+  with multiprocessing.get_context('fork').Pool(4) as pool:
+    locations.update(pool.imap_unordered(_stream,
+        [(directory,i) for i in range(200)],chunksize=1))
+  locations[-2] = s.append(_entry(8))
+  s.close()
+  for i,loc in locations.items():
+    expected = _entry({-1:7,-2:8}.get(i,i))
+    assert np.array_equal(s.get(*loc),expected),(i,loc)
+  s.close()